@@ -1,5 +1,7 @@
 import asyncio
+import signal
 
+from piggy.cli import serve, shutdown
 from piggy.piggy import Piggy
 
 
@@ -7,34 +9,49 @@ from piggy.piggy import Piggy
 # Main - User defined function
 ###
 
-async def main(pig):
-    async for media in pig.feed():
-        await pig.print(media)
-#       await pig.like(media)
-#       await pig.comment(media)
-#       await pig.follow(media)
+async def main(pig, media):
+    await pig.print(media)
+#   await pig.like(media)
+#   await pig.comment(media)
+#   await pig.follow(media)
 
 ###
 # Execution
 ###
 
-loop = asyncio.get_event_loop()
-pig = Piggy(loop)
+async def run(pig, stop):
+    jobs = []
 
-try:
-    loop.run_until_complete(pig.setup())
-    loop.run_until_complete(pig.login())
+    async def action(media):
+        await main(pig, media)
+
+    try:
+        await pig.setup()
+        await pig.login()
 
-    loop.create_task(pig.backup())
-    loop.create_task(main(pig))
+        jobs.append((asyncio.ensure_future(pig.backup()), False))
+        if pig.settings["following"]["unfollow_non_followers"]:
+            jobs.append(
+                (asyncio.ensure_future(pig.unfollow_non_followers()), True)
+            )
 
-    loop.run_forever()
+        await serve(pig, action, pig.feed(), stop)
+    finally:
+        await shutdown(pig, jobs)
 
-except KeyboardInterrupt:
-    loop.run_until_complete(pig.close())
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+pig = Piggy(loop)
+
+stop = asyncio.Event()
+for signum in [signal.SIGINT, signal.SIGTERM]:
+    try:
+        loop.add_signal_handler(signum, stop.set)
+    except NotImplementedError:
+        pass
 
+try:
+    loop.run_until_complete(run(pig, stop))
 finally:
-    for task in asyncio.Task.all_tasks():
-        task.cancel()
-    loop.run_until_complete(asyncio.wait(asyncio.Task.all_tasks()))
+    loop.run_until_complete(loop.shutdown_asyncgens())
     loop.close()
@@ -0,0 +1,111 @@
+async def count(db, action, ts, n=1):
+    """
+    Adds n to the counter of an action in the hour of ts. Like the other
+    updates below, it doesn't commit: the counter is committed together with
+    the action it counts.
+
+    Args:
+        db: An open aiosqlite connection.
+        action: [String] E.g. "like", "comment", "follow".
+        ts: [Int] Unix timestamp of the action.
+        n: [Int] Number of actions.
+    """
+
+    await db.execute(
+        """
+        INSERT INTO stats_activity VALUES(?,?,?)
+        ON CONFLICT(action, hour) DO UPDATE SET count=count+excluded.count
+        """,
+        (action, ts // 3600, n)
+    )
+
+
+async def follow(db, ts):
+    """
+    Counts a user followed at ts in the follow back statistics.
+    """
+
+    await db.execute(
+        """
+        INSERT INTO stats_follow_back VALUES(?,1,0,0)
+        ON CONFLICT(day) DO UPDATE SET follows=follows+1
+        """,
+        (ts // 86400,)
+    )
+
+
+async def follow_back(db, ts_followed, ts):
+    """
+    Counts a user, followed by Piggy at ts_followed, who followed back by ts.
+    """
+
+    await db.execute(
+        """
+        INSERT INTO stats_follow_back VALUES(?,0,1,?)
+        ON CONFLICT(day) DO UPDATE SET
+        followed_back=followed_back+1,
+        delay=delay+excluded.delay
+        """,
+        (ts_followed // 86400, max(ts - ts_followed, 0))
+    )
+
+
+async def activity(db, action, since, by="day"):
+    """
+    Returns the number of actions per day or per hour.
+
+    Args:
+        db: An open aiosqlite connection.
+        action: [String] E.g. "like".
+        since: [Int] Unix timestamp of the first period.
+        by: [String] Either "day" or "hour".
+
+    Returns:
+        A list of (period start timestamp, count) tuples.
+    """
+
+    if by == "day":
+        period = 24
+    elif by == "hour":
+        period = 1
+    else:
+        raise ValueError(f"Invalid period: {by}")
+
+    rows = await db.execute(
+        """
+        SELECT hour / ? * ? * 3600 AS start, SUM(count)
+        FROM stats_activity
+        WHERE action=? AND hour>=?
+        GROUP BY start
+        ORDER BY start
+        """,
+        (period, period, action, since // 3600 // period * period)
+    )
+    return await rows.fetchall()
+
+
+async def follow_backs(db, since):
+    """
+    Returns the follow back statistics by day of the follow.
+
+    Args:
+        db: An open aiosqlite connection.
+        since: [Int] Unix timestamp of the first day.
+
+    Returns:
+        A list of (day start timestamp, follows, followed back, follow back
+        rate, average seconds to follow back) tuples.
+    """
+
+    rows = await db.execute(
+        """
+        SELECT day * 86400, follows, followed_back,
+        CASE WHEN follows>0 THEN CAST(followed_back AS REAL) / follows END,
+        CASE WHEN followed_back>0 THEN delay / followed_back END
+        FROM stats_follow_back
+        WHERE day>=?
+        ORDER BY day
+        """,
+        (since // 86400,)
+    )
+    return await rows.fetchall()
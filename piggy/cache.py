@@ -0,0 +1,192 @@
+import json
+import logging
+import time
+
+from urllib.parse import urlsplit
+
+import aiosqlite
+
+
+logger = logging.getLogger(__name__)
+
+# Login and session pages are never cached, whatever the configuration: a
+# stale csrf token or session check would break the login
+NEVER_CACHED = ("/accounts/",)
+
+
+class ResponseCache:
+    """
+    On-disk cache of HTTP responses stored in an SQLite database.
+
+    Every entry expires after a time to live which depends on the path of the
+    requested URL. When the total size of the cached bodies exceeds the size
+    cap, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path="./cache.db", max_size=50*1024*1024, ttl=None):
+        """
+        Args:
+            path: [String] Path of the SQLite database.
+            max_size: [Int] Maximum total size of the cached bodies in bytes.
+            ttl: [Dict] Time to live in seconds by URL path prefix. The
+            "default" key applies to the paths without a matching prefix.
+            A time to live of 0 disables caching. The paths in NEVER_CACHED
+            are never cached.
+        """
+
+        self.path = path
+        self.max_size = max_size
+        if ttl is None:
+            ttl = {"default": 0}
+        self.ttl = ttl
+        self.db = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def open(self):
+        self.db = await aiosqlite.connect(self.path)
+        await self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body TEXT,
+                size INTEGER,
+                expires INTEGER,
+                accessed INTEGER
+            )
+            """
+        )
+        await self.db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)"
+        )
+        await self.db.execute(
+            "DELETE FROM responses WHERE expires<=?",
+            (int(time.time()),)
+        )
+        await self.db.commit()
+
+        c = await self.db.execute("SELECT TOTAL(size) FROM responses")
+        self.size = int((await c.fetchone())[0])
+
+    async def close(self):
+        if self.db is not None:
+            logger.info(f"Cache: {self.hits} hits, {self.misses} misses.")
+            await self.db.close()
+            self.db = None
+
+    def ttl_for(self, url):
+        """
+        Returns the time to live of the responses to the given URL.
+        """
+
+        path = urlsplit(url).path
+        if path.startswith(NEVER_CACHED):
+            return 0
+        prefixes = [p for p in self.ttl if p != "default" and path.startswith(p)]
+        if prefixes:
+            return self.ttl[max(prefixes, key=len)]
+        return self.ttl.get("default", 0)
+
+    @staticmethod
+    def _key(request_key, response_type):
+        return json.dumps([request_key, response_type])
+
+    async def get(self, request_key, response_type):
+        """
+        Looks up a response.
+
+        Args:
+            request_key: The key returned by utils.request_key().
+            response_type: [String] Either "text" or "json".
+
+        Returns:
+            The cached response or None if it isn't cached or it expired.
+        """
+
+        key = self._key(request_key, response_type)
+        now = int(time.time())
+        c = await self.db.execute(
+            "SELECT body FROM responses WHERE key=? AND expires>?",
+            (key, now)
+        )
+        row = await c.fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        await self.db.execute(
+            "UPDATE responses SET accessed=? WHERE key=?",
+            (now, key)
+        )
+        await self.db.commit()
+
+        if response_type == "json":
+            return json.loads(row[0])
+        return row[0]
+
+    async def set(self, request_key, response_type, response):
+        """
+        Stores a response, evicting the least recently used entries if the
+        size cap is exceeded.
+
+        Args:
+            request_key: The key returned by utils.request_key().
+            response_type: [String] Either "text" or "json".
+            response: The response to store.
+
+        Returns:
+            None
+        """
+
+        ttl = self.ttl_for(request_key[1])
+        if ttl <= 0:
+            return
+
+        if response_type == "json":
+            body = json.dumps(response)
+        else:
+            body = response
+        size = len(body.encode("utf-8"))
+        if size > self.max_size:
+            return
+
+        key = self._key(request_key, response_type)
+        c = await self.db.execute(
+            "SELECT size FROM responses WHERE key=?",
+            (key,)
+        )
+        row = await c.fetchone()
+        if row is not None:
+            self.size -= row[0]
+
+        now = int(time.time())
+        await self.db.execute(
+            "INSERT OR REPLACE INTO responses VALUES(?,?,?,?,?)",
+            (key, body, size, now + ttl, now)
+        )
+        self.size += size
+
+        if self.size > self.max_size:
+            await self._evict(now)
+
+        await self.db.commit()
+
+    async def _evict(self, now):
+        # Drop the expired responses first, then the least recently used ones
+        await self.db.execute("DELETE FROM responses WHERE expires<=?", (now,))
+        c = await self.db.execute("SELECT TOTAL(size) FROM responses")
+        self.size = int((await c.fetchone())[0])
+
+        evicted = []
+        c = await self.db.execute(
+            "SELECT key, size FROM responses ORDER BY accessed"
+        )
+        for key, size in await c.fetchall():
+            if self.size <= self.max_size:
+                break
+            evicted.append((key,))
+            self.size -= size
+        await self.db.executemany("DELETE FROM responses WHERE key=?", evicted)
+        logger.debug(f"Cache: evicted {len(evicted)} responses.")
@@ -0,0 +1,404 @@
+import argparse
+import asyncio
+import logging
+import signal
+import time
+
+from piggy.piggy import Piggy
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args(argv=None):
+    # Options accepted both before and after the command. They have no
+    # default of their own so that a subcommand doesn't reset a value given
+    # before it: the defaults are filled in after parsing
+    common = argparse.ArgumentParser(
+        add_help=False, argument_default=argparse.SUPPRESS
+    )
+    common.add_argument(
+        "--settings",
+        help="path of the settings file (default: settings.json)"
+    )
+    common.add_argument(
+        "--uvloop", action="store_true",
+        help="use the uvloop event loop policy, if installed"
+    )
+    common.add_argument(
+        "--wait-time", type=int,
+        help="initial wait time in seconds before each request"
+    )
+    common.add_argument(
+        "--cache", action="store_true",
+        help="cache GET responses on disk"
+    )
+    common.add_argument(
+        "--record", metavar="PATH",
+        help="record the HTTP traffic to PATH"
+    )
+    common.add_argument(
+        "--replay", metavar="PATH",
+        help="replay the HTTP traffic recorded in PATH"
+    )
+    common.add_argument(
+        "--time-scale", type=float,
+        help="factor applied to the recorded response times when replaying"
+    )
+
+    parser = argparse.ArgumentParser(
+        prog="piggy",
+        description="Manage an Instagram account asynchronously.",
+        parents=[common]
+    )
+
+    feed = argparse.ArgumentParser(add_help=False)
+    feed.add_argument(
+        "--no-explore", dest="explore", action="store_false",
+        help="don't add the explore page to the feed"
+    )
+    feed.add_argument(
+        "--hashtag", dest="hashtags", action="append", default=[],
+        help="add the media of a hashtag to the feed (repeatable)"
+    )
+    feed.add_argument(
+        "--location", dest="locations", action="append", default=[],
+        help="add the media of a location id to the feed (repeatable)"
+    )
+    feed.add_argument(
+        "--user", dest="users", action="append", default=[],
+        help="add the media of a user to the feed (repeatable)"
+    )
+    feed.add_argument(
+        "--concurrency", type=int, default=4,
+        help="maximum number of feed sources fetched at once (default: 4)"
+    )
+    feed.add_argument(
+        "--prefetch", type=int, default=50,
+        help="maximum number of media loaded in advance (default: 50)"
+    )
+
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run = subparsers.add_parser(
+        "run", parents=[common, feed], help="run the bot on the feed"
+    )
+    run.add_argument(
+        "--print", action="store_true", help="print every media"
+    )
+    run.add_argument("--like", action="store_true", help="like media")
+    run.add_argument("--comment", action="store_true", help="comment media")
+    run.add_argument(
+        "--follow", action="store_true", help="follow the owners of media"
+    )
+    run.add_argument(
+        "--budget", metavar="ACTION=HOURLY/DAILY", action="append",
+        type=parse_budget, default=[],
+        help="schedule an action within hourly and daily limits, e.g. "
+        "like=60/1000 (repeatable)"
+    )
+    run.add_argument(
+        "--unfollow-non-followers", action="store_true",
+        help="unfollow the users who don't follow back"
+    )
+
+    scrape = subparsers.add_parser(
+        "scrape", parents=[common, feed], help="download the media of the feed"
+    )
+    scrape.add_argument(
+        "--downloads", type=int,
+        help="maximum number of files downloaded at once"
+    )
+
+    subparsers.add_parser(
+        "export", parents=[common], help="export the database to the backups folder"
+    )
+
+    bench = subparsers.add_parser(
+        "bench", parents=[common, feed],
+        help="measure the feed throughput (best used with --replay)"
+    )
+    bench.add_argument(
+        "--count", type=int, default=500,
+        help="number of media to fetch (default: 500)"
+    )
+
+    args = parser.parse_args(argv)
+    defaults = {
+        "settings": "settings.json",
+        "uvloop": False,
+        "wait_time": None,
+        "cache": False,
+        "record": None,
+        "replay": None,
+        "time_scale": None
+    }
+    for name, value in defaults.items():
+        if not hasattr(args, name):
+            setattr(args, name, value)
+    return args
+
+
+def parse_budget(budget):
+    """
+    Parses a budget in the ACTION=HOURLY/DAILY format. A limit of 0 disables
+    the action.
+
+    Returns:
+        An (action, {"hourly": HOURLY, "daily": DAILY}) tuple.
+    """
+
+    try:
+        action, limits = budget.split("=")
+        hourly, daily = limits.split("/")
+        hourly, daily = int(hourly), int(daily)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid budget: {budget}")
+    if hourly < 0 or daily < 0:
+        raise argparse.ArgumentTypeError(f"Negative budget: {budget}")
+    return action, {"hourly": hourly, "daily": daily}
+
+
+def apply_args(settings, args):
+    """
+    Overrides the settings with the command line arguments.
+    """
+
+    if args.wait_time is not None:
+        settings["connection"]["wait_time"] = args.wait_time
+    if args.cache:
+        settings.setdefault("cache", dict())["active"] = True
+    if args.record:
+        settings["recording"] = dict(
+            settings.get("recording", dict()), mode="record", path=args.record
+        )
+    if args.replay:
+        settings["recording"] = dict(
+            settings.get("recording", dict()), mode="replay", path=args.replay
+        )
+    if args.time_scale is not None:
+        settings.setdefault("recording", dict())["time_scale"] = args.time_scale
+
+    if getattr(args, "budget", None):
+        scheduler = settings.setdefault("scheduler", dict())
+        scheduler["active"] = True
+        scheduler["budgets"] = dict(args.budget)
+    if getattr(args, "unfollow_non_followers", False):
+        settings["following"]["unfollow_non_followers"] = True
+    if getattr(args, "downloads", None):
+        settings.setdefault("download", dict())["concurrency"] = args.downloads
+
+
+async def serve(pig, action, feed, stop):
+    """
+    Applies an action to every media of the feed until the feed ends or stop
+    is set. An action already started is always completed. An action that
+    fails is logged and the next media is processed.
+
+    Args:
+        pig: A logged in Piggy instance.
+        action: A coroutine function taking a media.
+        feed: The feed returned by Piggy.feed().
+        stop: [asyncio.Event] Set to stop.
+
+    Returns:
+        The number of media processed.
+    """
+
+    processed = 0
+    busy = False
+
+    async def consume():
+        nonlocal processed, busy
+        async for media in feed:
+            busy = True
+            try:
+                await action(media)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Couldn't process media {media.shortcode}.")
+            else:
+                processed += 1
+            finally:
+                busy = False
+            if stop.is_set():
+                break
+
+    consumer = asyncio.ensure_future(consume())
+    stopper = asyncio.ensure_future(stop.wait())
+    await asyncio.wait([consumer, stopper], return_when=asyncio.FIRST_COMPLETED)
+
+    if not consumer.done() and not busy:
+        # Waiting for the next media: nothing to complete
+        consumer.cancel()
+    await asyncio.gather(consumer, return_exceptions=True)
+    stopper.cancel()
+    await feed.aclose()
+
+    if not consumer.cancelled() and consumer.exception() is not None:
+        logger.error("The feed failed.", exc_info=consumer.exception())
+
+    return processed
+
+
+async def shutdown(pig, jobs, timeout=30):
+    """
+    Stops the background jobs and closes Piggy.
+
+    Args:
+        pig: The Piggy instance.
+        jobs: [List] (task, drain) tuples. The tasks with drain set to True
+        stop on their own when Piggy is stopping and they are given up to
+        "timeout" seconds to do so. The others are cancelled right away.
+        timeout: [Number] Seconds to wait for the jobs.
+
+    Returns:
+        None
+    """
+
+    pig.stopping.set()
+    for task, drain in jobs:
+        if not drain:
+            task.cancel()
+
+    tasks = [task for task, _ in jobs]
+    if tasks:
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    await pig.close()
+
+
+async def execute(pig, args, stop):
+    if args.command == "export":
+        pig.setup_logging()
+        await pig.export()
+        return
+
+    jobs = []
+    downloads = set()
+    try:
+        await pig.setup()
+        await pig.login()
+    except BaseException:
+        await shutdown(pig, jobs)
+        raise
+
+    feed = pig.feed(
+        explore=args.explore,
+        users=args.users,
+        hashtags=args.hashtags,
+        locations=args.locations,
+        concurrency=args.concurrency,
+        prefetch=args.prefetch
+    )
+
+    if args.command == "run":
+        jobs.append((asyncio.ensure_future(pig.backup()), False))
+        if pig.settings["following"]["unfollow_non_followers"]:
+            jobs.append(
+                (asyncio.ensure_future(pig.unfollow_non_followers()), True)
+            )
+
+        async def action(media):
+            if args.print:
+                await pig.print(media)
+            if args.like:
+                await pig.like(media)
+            if args.comment:
+                await pig.comment(media)
+            if args.follow:
+                await pig.follow(media)
+
+    elif args.command == "scrape":
+        # Several media are downloaded at once, the files of all of them
+        # within the download concurrency
+        slots = asyncio.Semaphore(pig.settings["download"]["concurrency"])
+
+        async def download(media):
+            try:
+                await pig.download(media)
+            except Exception:
+                logger.exception(f"Couldn't download {media.shortcode}.")
+            finally:
+                slots.release()
+
+        async def action(media):
+            await slots.acquire()
+            task = asyncio.ensure_future(download(media))
+            downloads.add(task)
+            task.add_done_callback(downloads.discard)
+
+    elif args.command == "bench":
+        fetched = 0
+
+        async def action(media):
+            nonlocal fetched
+            fetched += 1
+            if fetched >= args.count:
+                stop.set()
+
+    start = time.monotonic()
+    try:
+        processed = await serve(pig, action, feed, stop)
+        if downloads:
+            await asyncio.wait(downloads)
+    finally:
+        for task in downloads:
+            task.cancel()
+        await asyncio.gather(*downloads, return_exceptions=True)
+        await shutdown(pig, jobs)
+
+    if args.command == "bench":
+        # Only the feed pages are counted: the login and the followers sync
+        # are not part of the feed throughput
+        elapsed = time.monotonic() - start
+        requests = sum(
+            sizer.requests + sizer.failures
+            for sizer in pig.page_sizers.values()
+        )
+        logger.info(
+            f"{processed} media in {elapsed:.2f}s: {processed / elapsed:.1f} media/s, {requests} feed requests, {processed / max(requests, 1):.1f} media per request."
+        )
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            logging.warning("uvloop is not installed. Using asyncio.")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    pig = Piggy(loop)
+    pig.load_settings(args.settings)
+    apply_args(pig.settings, args)
+
+    stop = asyncio.Event()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except NotImplementedError:
+            # Windows: KeyboardInterrupt is raised instead
+            pass
+
+    try:
+        loop.run_until_complete(execute(pig, args, stop))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
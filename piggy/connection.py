@@ -0,0 +1,124 @@
+import asyncio
+import logging
+
+from collections import defaultdict
+
+import aiohttp
+
+from aiohttp.client_exceptions import ClientError
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionManager:
+    """
+    Owns the http sessions used by Piggy. API requests to www.instagram.com
+    and media downloads from the CDN go through two long-lived sessions with
+    tuned TCP connectors, so that DNS lookups are cached and connections are
+    kept alive and reused.
+    """
+
+    def __init__(self, settings):
+        """
+        Args:
+            settings: [Dict] The "connection" section of the settings.
+        """
+
+        self.settings = settings
+        self.stats = defaultdict(lambda: {"created": 0, "reused": 0})
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_create_end.append(
+            self._on_connection_create_end
+        )
+        trace_config.on_connection_reuseconn.append(
+            self._on_connection_reuseconn
+        )
+
+        timeout = aiohttp.ClientTimeout(total=settings["timeout"])
+
+        headers = {
+            "DNT": "1",
+            "Host": "www.instagram.com",
+            "Upgrade-Insecure-Requests": "1",
+            "User-Agent": settings["user_agent"]
+        }
+        self.api = aiohttp.ClientSession(
+            connector=self._connector(settings.get("api_limit_per_host", 10)),
+            headers=headers,
+            timeout=timeout,
+            trace_configs=[trace_config]
+        )
+
+        headers = {
+            "User-Agent": settings["user_agent"]
+        }
+        self.cdn = aiohttp.ClientSession(
+            connector=self._connector(settings.get("cdn_limit_per_host", 20)),
+            headers=headers,
+            timeout=timeout,
+            trace_configs=[trace_config]
+        )
+
+    def _connector(self, limit_per_host):
+        return aiohttp.TCPConnector(
+            limit=self.settings.get("limit", 100),
+            limit_per_host=limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=self.settings.get("dns_cache_ttl", 300),
+            keepalive_timeout=self.settings.get("keepalive_timeout", 60)
+        )
+
+    async def _on_request_start(self, session, ctx, params):
+        ctx.host = params.url.host
+
+    async def _on_connection_create_end(self, session, ctx, params):
+        self.stats[ctx.host]["created"] += 1
+
+    async def _on_connection_reuseconn(self, session, ctx, params):
+        self.stats[ctx.host]["reused"] += 1
+
+    async def prewarm(self):
+        """
+        Opens a connection to www.instagram.com and to the CDN hosts listed in
+        the "prewarm_hosts" setting, so that the DNS resolution and the TLS
+        handshake are done before the first real request.
+
+        Returns:
+            None
+        """
+
+        hosts = ["www.instagram.com"] + self.settings.get("prewarm_hosts", [])
+        for host in hosts:
+            if host == "www.instagram.com":
+                session = self.api
+            else:
+                session = self.cdn
+
+            try:
+                async with session.head(f"https://{host}/") as r:
+                    logger.debug(f"Prewarmed {host}: {r.status}")
+            except (ClientError, asyncio.TimeoutError):
+                logger.warning(f"Could not prewarm {host}.")
+
+    def report(self):
+        """
+        Logs the number of connections created and reused for each host.
+
+        Returns:
+            The statistics as a dictionary.
+        """
+
+        for host, stats in self.stats.items():
+            total = stats["created"] + stats["reused"]
+            if total:
+                logger.info(
+                    f"{host}: {stats['created']} connections created, {stats['reused']} reused ({stats['reused'] / total:.0%})"
+                )
+        return dict(self.stats)
+
+    async def close(self):
+        await self.api.close()
+        await self.cdn.close()
@@ -0,0 +1,82 @@
+FOLLOWERS = 0
+FOLLOWING = 1
+
+
+def _relation(name):
+    if name == "followers":
+        return FOLLOWERS
+    elif name == "following":
+        return FOLLOWING
+    raise ValueError(f"Invalid relation: {name}")
+
+
+async def snapshot(db, relation, ts):
+    """
+    Reconstructs a followers or following list as it was at ts.
+
+    Args:
+        db: An open aiosqlite connection.
+        relation: [String] Either "followers" or "following".
+        ts: [Int] Unix timestamp.
+
+    Returns:
+        A set of user ids.
+    """
+
+    # The gained flag is taken from the latest event of each user
+    rows = await db.execute(
+        """
+        SELECT user_id, gained, MAX(ts) FROM follower_events
+        WHERE relation=? AND ts<=?
+        GROUP BY user_id
+        """,
+        (_relation(relation), ts)
+    )
+    return {user_id for user_id, gained, _ in await rows.fetchall() if gained}
+
+
+async def record(db, relation, ids, ts):
+    """
+    Compares a freshly fetched list with the last known one and stores the
+    users gained and lost. It doesn't commit.
+
+    Args:
+        db: An open aiosqlite connection.
+        relation: [String] Either "followers" or "following".
+        ids: [Iterable] Ids of the users currently in the list.
+        ts: [Int] Unix timestamp of the update.
+
+    Returns:
+        A (gained, lost) tuple of sets of user ids.
+    """
+
+    current = {int(id) for id in ids}
+    previous = await snapshot(db, relation, ts)
+    gained = current - previous
+    lost = previous - current
+
+    r = _relation(relation)
+    await db.executemany(
+        "INSERT INTO follower_events VALUES(?,?,?,?)",
+        [(ts, r, id, True) for id in gained] +
+        [(ts, r, id, False) for id in lost]
+    )
+    return gained, lost
+
+
+async def changes(db, relation, since, until):
+    """
+    Returns the users gained and lost in a time interval as a list of
+    (ts, user id, username, gained) tuples sorted by time.
+    """
+
+    rows = await db.execute(
+        """
+        SELECT e.ts, e.user_id, u.username, e.gained
+        FROM follower_events e LEFT JOIN users u ON u.id=e.user_id
+        WHERE e.relation=? AND e.ts>=? AND e.ts<=?
+        ORDER BY e.ts
+        """,
+        (_relation(relation), since, until)
+    )
+    return await rows.fetchall()
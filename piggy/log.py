@@ -0,0 +1,117 @@
+import atexit
+import logging
+import queue
+import reprlib
+
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from random import random
+
+
+_listener = None
+
+# Bounded representation of response bodies. Nested GraphQL responses are cut
+# down before being turned into a string.
+_body_repr = reprlib.Repr()
+_body_repr.maxlevel = 4
+_body_repr.maxdict = 8
+_body_repr.maxlist = 4
+_body_repr.maxstring = 120
+_body_repr.maxother = 120
+
+
+def setup_logging(
+    path="./piggy.log", max_bytes=5*1024*1024, backup_count=3,
+    console_level=logging.INFO, file_level=logging.DEBUG
+):
+    """
+    Sets up the "piggy" logger. The records are put in a queue by the caller
+    and written to the console and to a size-rotated log file by a background
+    thread, so that the event loop never blocks on I/O.
+
+    Calling this function more than once has no effect.
+
+    Args:
+        path: [String] Path of the log file.
+        max_bytes: [Int] Size after which the log file is rotated.
+        backup_count: [Int] Number of rotated log files to keep.
+        console_level: Level of the records printed to the console.
+        file_level: Level of the records written to the log file.
+
+    Returns:
+        None
+    """
+
+    global _listener
+
+    if _listener is not None:
+        return
+
+    logger = logging.getLogger("piggy")
+    logger.setLevel(min(console_level, file_level))
+
+    ch = logging.StreamHandler()
+    fh = RotatingFileHandler(
+        path,
+        maxBytes=max_bytes,
+        backupCount=backup_count,
+        encoding="utf-8"
+    )
+
+    ch.setLevel(console_level)
+    fh.setLevel(file_level)
+    ch.setFormatter(logging.Formatter("%(message)s"))
+    fh.setFormatter(logging.Formatter(
+        "[%(asctime)s] %(levelname)s %(funcName)s: %(message)s"
+    ))
+
+    q = queue.Queue(-1)
+    logger.addHandler(QueueHandler(q))
+
+    _listener = QueueListener(q, ch, fh, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """
+    Flushes the pending records and stops the background writer.
+    """
+
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log_body(logger, body, limit=1000, sample_rate=1.0):
+    """
+    Logs a response body at debug level. The body is truncated to "limit"
+    characters and only a "sample_rate" fraction of the bodies is logged.
+    Nothing is formatted when neither the console nor the log file accept
+    debug records.
+
+    Args:
+        logger: The logger to use.
+        body: [String or Dict] The response body.
+        limit: [Int] Maximum number of characters to log.
+        sample_rate: [Float] Fraction of the bodies to log (0 to 1).
+
+    Returns:
+        None
+    """
+
+    if not logger.isEnabledFor(logging.DEBUG) or sample_rate <= random():
+        return
+
+    if isinstance(body, str):
+        text = body[:limit]
+        truncated = len(body) > limit
+    else:
+        text = _body_repr.repr(body)
+        truncated = len(text) > limit
+        text = text[:limit]
+
+    if truncated:
+        text += "..."
+    logger.debug(text)
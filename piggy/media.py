@@ -0,0 +1,130 @@
+class Media:
+    """
+    Compact representation of an Instagram media.
+
+    Only the fields used by Piggy are extracted from the GraphQL node when the
+    media is parsed. The raw node is kept only when explicitly requested,
+    otherwise it is discarded as soon as the media is created.
+    """
+
+    __slots__ = (
+        "id",
+        "shortcode",
+        "typename",
+        "owner_id",
+        "likes",
+        "comments",
+        "display_url",
+        "height",
+        "width",
+        "caption",
+        "comments_disabled",
+        "video_url",
+        "children",
+        "_node"
+    )
+
+    def __init__(
+        self, id, shortcode, typename, owner_id=None, likes=0, comments=0,
+        display_url=None, height=None, width=None, caption=None,
+        comments_disabled=False, video_url=None, children=None, node=None
+    ):
+        self.id = id
+        self.shortcode = shortcode
+        self.typename = typename
+        self.owner_id = owner_id
+        self.likes = likes
+        self.comments = comments
+        self.display_url = display_url
+        self.height = height
+        self.width = width
+        self.caption = caption
+        self.comments_disabled = comments_disabled
+        self.video_url = video_url
+        self.children = children
+        self._node = node
+
+    @classmethod
+    def from_node(cls, node, keep_node=False):
+        """
+        Parses a GraphQL media node.
+
+        Args:
+            node: [Dict] The "node" element of a GraphQL media edge.
+            keep_node: [Bool] If True the raw node is retained and can be
+            accessed through the "node" property.
+
+        Returns:
+            A Media instance.
+        """
+
+        try:
+            typename = node["__typename"]
+        except KeyError:
+            if node.get("is_video"):
+                typename = "GraphVideo"
+            else:
+                typename = "GraphImage"
+
+        try:
+            likes = node["edge_liked_by"]["count"]
+        except KeyError:
+            likes = node.get("edge_media_preview_like", {}).get("count", 0)
+
+        try:
+            comments = node["edge_media_to_comment"]["count"]
+        except KeyError:
+            comments = 0
+
+        try:
+            caption = node["edge_media_to_caption"]["edges"][0]["node"]["text"]
+        except (KeyError, IndexError):
+            caption = None
+
+        dimensions = node.get("dimensions", {})
+
+        # Album children are only included in some responses
+        try:
+            children = tuple(
+                cls.from_node(child["node"])
+                for child in node["edge_sidecar_to_children"]["edges"]
+            )
+        except KeyError:
+            children = None
+
+        return cls(
+            node["id"],
+            node.get("shortcode"),
+            typename,
+            owner_id=node.get("owner", {}).get("id"),
+            likes=likes,
+            comments=comments,
+            display_url=node.get("display_url"),
+            height=dimensions.get("height"),
+            width=dimensions.get("width"),
+            caption=caption,
+            comments_disabled=node.get("comments_disabled", False),
+            video_url=node.get("video_url"),
+            children=children,
+            node=node if keep_node else None
+        )
+
+    @property
+    def node(self):
+        """
+        The raw GraphQL node. Only available if the media was parsed with
+        keep_node=True.
+        """
+
+        if self._node is None:
+            raise AttributeError(
+                f"Raw node of media {self.id} was not retained."
+            )
+        return self._node
+
+    @property
+    def is_video(self):
+        return self.typename == "GraphVideo"
+
+    def __repr__(self):
+        return f"<Media {self.typename} {self.shortcode}>"
@@ -0,0 +1,361 @@
+import logging
+import sqlite3
+
+
+logger = logging.getLogger(__name__)
+
+
+async def _initial_schema(db):
+    # Tables as created before the schema was versioned
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pics (
+            id INT,
+            height INT,
+            width INT,
+            url TEXT,
+            tags TEXT
+        )
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tags (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE
+        )
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pic_tags (
+            tag_id INTEGER,
+            pic_id INTEGER,
+            PRIMARY KEY (tag_id, pic_id)
+        ) WITHOUT ROWID
+        """
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS pic_tags_pic ON pic_tags(pic_id)"
+    )
+
+    # Index the tags of the pics saved before the tags table existed
+    await db.execute(
+        """
+        INSERT OR IGNORE INTO tags(name)
+        SELECT DISTINCT lower(j.value) FROM pics, json_each(pics.tags) j
+        """
+    )
+    await db.execute(
+        """
+        INSERT OR IGNORE INTO pic_tags
+        SELECT tags.id, pics.id FROM pics, json_each(pics.tags) j
+        JOIN tags ON tags.name=lower(j.value)
+        """
+    )
+
+    try:
+        await db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS pics_fts USING fts5(caption)"
+        )
+    except sqlite3.OperationalError:
+        logger.warning("FTS5 not available: captions won't be indexed.")
+
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT,
+            username TEXT,
+            ts_follower INTEGER,
+            ts_following INTEGER,
+            follower BOOL,
+            following BOOL
+        )
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS likes (
+            id INTEGER,
+            ts INTEGER
+        )
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS comments (
+            id INTEGER,
+            ts INTEGER,
+            comment TEXT
+        )
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            name TEXT,
+            cutoff INTEGER,
+            last_ts INTEGER,
+            last_id TEXT,
+            done INTEGER
+        )
+        """
+    )
+
+
+async def _keys_and_indexes(db):
+    # Rebuild the tables with primary keys, merging duplicated rows
+    await db.execute(
+        """
+        CREATE TABLE users_new (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            ts_follower INTEGER,
+            ts_following INTEGER,
+            follower BOOL NOT NULL DEFAULT 0,
+            following BOOL NOT NULL DEFAULT 0
+        )
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO users_new
+        SELECT CAST(id AS INTEGER), MAX(username), MIN(ts_follower),
+        MAX(ts_following), COALESCE(MAX(follower), 0),
+        COALESCE(MAX(following), 0)
+        FROM users WHERE id IS NOT NULL
+        GROUP BY CAST(id AS INTEGER)
+        """
+    )
+    await db.execute("DROP TABLE users")
+    await db.execute("ALTER TABLE users_new RENAME TO users")
+    await db.execute(
+        """
+        CREATE INDEX users_non_followers
+        ON users(following, follower, ts_following, id)
+        """
+    )
+    await db.execute("CREATE INDEX users_username ON users(username)")
+
+    await db.execute(
+        """
+        CREATE TABLE likes_new (
+            id INTEGER PRIMARY KEY,
+            ts INTEGER
+        )
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO likes_new
+        SELECT CAST(id AS INTEGER), MIN(ts) FROM likes
+        WHERE id IS NOT NULL
+        GROUP BY CAST(id AS INTEGER)
+        """
+    )
+    await db.execute("DROP TABLE likes")
+    await db.execute("ALTER TABLE likes_new RENAME TO likes")
+    await db.execute("CREATE INDEX likes_ts ON likes(ts)")
+
+    # A media can be commented more than once: only exact copies are dropped
+    await db.execute(
+        """
+        CREATE TABLE comments_new (
+            id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            comment TEXT,
+            UNIQUE (id, ts, comment)
+        )
+        """
+    )
+    await db.execute(
+        """
+        INSERT OR IGNORE INTO comments_new
+        SELECT CAST(id AS INTEGER), ts, comment FROM comments
+        WHERE id IS NOT NULL AND ts IS NOT NULL
+        """
+    )
+    await db.execute("DROP TABLE comments")
+    await db.execute("ALTER TABLE comments_new RENAME TO comments")
+    await db.execute("CREATE INDEX comments_ts ON comments(ts)")
+
+    await db.execute(
+        """
+        CREATE TABLE pics_new (
+            id INTEGER PRIMARY KEY,
+            height INTEGER,
+            width INTEGER,
+            url TEXT,
+            tags TEXT
+        )
+        """
+    )
+    await db.execute(
+        """
+        INSERT OR IGNORE INTO pics_new
+        SELECT CAST(id AS INTEGER), height, width, url, tags FROM pics
+        WHERE id IS NOT NULL
+        """
+    )
+    await db.execute("DROP TABLE pics")
+    await db.execute("ALTER TABLE pics_new RENAME TO pics")
+
+    await db.execute(
+        """
+        CREATE TABLE jobs_new (
+            name TEXT PRIMARY KEY,
+            cutoff INTEGER,
+            last_ts INTEGER,
+            last_id INTEGER,
+            done INTEGER
+        )
+        """
+    )
+    await db.execute(
+        """
+        INSERT OR REPLACE INTO jobs_new
+        SELECT name, cutoff, last_ts, CAST(last_id AS INTEGER), done FROM jobs
+        """
+    )
+    await db.execute("DROP TABLE jobs")
+    await db.execute("ALTER TABLE jobs_new RENAME TO jobs")
+
+
+async def _analytics(db):
+    await db.execute(
+        """
+        CREATE TABLE stats_activity (
+            action TEXT,
+            hour INTEGER,
+            count INTEGER,
+            PRIMARY KEY (action, hour)
+        ) WITHOUT ROWID
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE stats_follow_back (
+            day INTEGER PRIMARY KEY,
+            follows INTEGER,
+            followed_back INTEGER,
+            delay INTEGER
+        )
+        """
+    )
+
+    # Aggregate the existing history. Up to this version ts_following was
+    # only written by follow(), so it only holds the follows made by Piggy.
+    # Later versions keep those in ts_followed (see _piggy_follows)
+    await db.execute(
+        """
+        INSERT INTO stats_activity
+        SELECT 'like', ts / 3600, COUNT(*) FROM likes
+        WHERE ts IS NOT NULL GROUP BY ts / 3600
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO stats_activity
+        SELECT 'comment', ts / 3600, COUNT(*) FROM comments
+        GROUP BY ts / 3600
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO stats_activity
+        SELECT 'follow', ts_following / 3600, COUNT(*) FROM users
+        WHERE ts_following IS NOT NULL GROUP BY ts_following / 3600
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO stats_follow_back
+        SELECT ts_following / 86400, COUNT(*),
+        SUM(follower=1 AND ts_follower>=ts_following),
+        SUM(CASE WHEN follower=1 AND ts_follower>=ts_following
+            THEN ts_follower - ts_following ELSE 0 END)
+        FROM users
+        WHERE ts_following IS NOT NULL
+        GROUP BY ts_following / 86400
+        """
+    )
+
+
+async def _follower_history(db):
+    await db.execute(
+        """
+        CREATE TABLE follower_events (
+            ts INTEGER NOT NULL,
+            relation INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            gained BOOL NOT NULL
+        )
+        """
+    )
+    await db.execute(
+        """
+        CREATE INDEX follower_events_user
+        ON follower_events(relation, user_id, ts)
+        """
+    )
+    await db.execute(
+        "CREATE INDEX follower_events_ts ON follower_events(relation, ts)"
+    )
+
+
+async def _pics_media(db):
+    # Videos and album children are saved as well
+    await db.execute("ALTER TABLE pics ADD COLUMN type TEXT")
+    await db.execute("ALTER TABLE pics ADD COLUMN parent_id INTEGER")
+    await db.execute("UPDATE pics SET type='GraphImage'")
+    await db.execute("CREATE INDEX pics_parent ON pics(parent_id)")
+
+
+async def _piggy_follows(db):
+    # The following list sync records when an account was first seen among
+    # the followed ones: the follows made by Piggy are kept apart. Until now
+    # ts_following was only written when following, so it is copied over
+    await db.execute("ALTER TABLE users ADD COLUMN ts_followed INTEGER")
+    await db.execute("UPDATE users SET ts_followed=ts_following")
+    await db.execute("CREATE INDEX users_ts_followed ON users(ts_followed)")
+
+
+# Migrations are applied in order and never modified once released: the
+# schema version stored in the database is the number of applied migrations.
+MIGRATIONS = [
+    _initial_schema,
+    _keys_and_indexes,
+    _analytics,
+    _follower_history,
+    _pics_media,
+    _piggy_follows
+]
+
+
+async def migrate(db):
+    """
+    Brings the schema of the database to the latest version. Each migration
+    runs in its own transaction.
+
+    Args:
+        db: An open aiosqlite connection.
+
+    Returns:
+        The schema version.
+    """
+
+    c = await db.execute("PRAGMA user_version")
+    version = (await c.fetchone())[0]
+
+    for i, migration in enumerate(MIGRATIONS[version:], start=version+1):
+        logger.info(f"Migrating database to version {i}...")
+        await db.execute("BEGIN")
+        try:
+            await migration(db)
+            await db.execute(f"PRAGMA user_version={i}")
+        except Exception:
+            await db.rollback()
+            raise
+        await db.commit()
+
+    return len(MIGRATIONS)
@@ -0,0 +1,75 @@
+class PageSizer:
+    """
+    Chooses the page size of a paginated GraphQL query. The size is doubled
+    as long as the server returns full pages and it is capped to the number
+    of returned items when the server twice returns the same amount, less
+    than requested, while more pages are available, i.e. when the server
+    caps the page size. After "probe_after" full pages at the cap, larger
+    pages are tried again. Errors and 429s halve the size.
+    """
+
+    def __init__(self, initial=12, minimum=1, maximum=100, probe_after=20):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.ceiling = maximum
+        self.probe_after = probe_after
+        self.short = None
+        self.full = 0
+        self.requests = 0
+        self.items = 0
+        self.failures = 0
+
+    def success(self, requested, received, has_next_page, throttled=False):
+        """
+        Updates the page size after a successful request.
+
+        Args:
+            requested: [Int] The requested page size.
+            received: [Int] The number of items received.
+            has_next_page: [Bool] Whether there are more pages.
+            throttled: [Bool] Whether the request got 429s before succeeding.
+
+        Returns:
+            None
+        """
+
+        self.requests += 1
+        self.items += received
+
+        if throttled:
+            self.size = max(self.size // 2, self.minimum)
+        elif has_next_page and 0 < received < requested:
+            # A single short page may just miss removed media: the server
+            # caps the page size only if the same count comes back again
+            if received == self.short:
+                self.ceiling = received
+                self.size = received
+            self.short = received
+            self.full = 0
+        elif received >= requested:
+            self.short = None
+            if self.ceiling < self.maximum and requested >= self.ceiling:
+                self.full += 1
+                if self.full >= self.probe_after:
+                    # The cap may have been lifted
+                    self.ceiling = self.maximum
+                    self.full = 0
+            self.size = min(self.size * 2, self.ceiling)
+
+    def failure(self):
+        """
+        Halves the page size after a failed request.
+        """
+
+        self.failures += 1
+        self.size = max(self.size // 2, self.minimum)
+
+    @property
+    def items_per_request(self):
+        if not self.requests:
+            return 0
+        return self.items / self.requests
+
+    def __repr__(self):
+        return f"<PageSizer size={self.size} ceiling={self.ceiling} items/request={self.items_per_request:.1f}>"
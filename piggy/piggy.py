@@ -1,71 +1,172 @@
 import logging
 import json
+import os
 import time
 
 from random import random, randint
+from urllib.parse import urlsplit
 
 import asyncio
-import aiohttp
 import aiosqlite
 import aiofiles
 import regex
 
-from aiohttp.client_exceptions import ClientConnectorError
+from aiohttp.client_exceptions import ClientConnectorError, ClientError
+from yarl import URL
 
-from piggy import utils
+from piggy import analytics, history, log, utils
+from piggy.cache import ResponseCache
+from piggy.connection import ConnectionManager
+from piggy.media import Media
+from piggy.migrations import migrate
+from piggy.paging import PageSizer
+from piggy.replay import Player, Recorder, Response
+from piggy.scheduler import ActionScheduler, Budget
+from piggy.sources import SourceScheduler
 
 
 # Logging
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-
-ch = logging.StreamHandler()
-fh = logging.FileHandler("./piggy.log")
-
-ch.setLevel(logging.INFO)
-fh.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(message)s")
-ch.setFormatter(formatter)
-formatter = logging.Formatter(
-    "[%(asctime)s] %(levelname)s %(funcName)s: %(message)s"
-)
-fh.setFormatter(formatter)
-logger.addHandler(ch)
-logger.addHandler(fh)
 
 
 class Piggy:
     def __init__(self, loop):
         self.loop = loop
+        self.settings = None
+
+        # Set when Piggy is shutting down: long running jobs stop at the
+        # next safe point
+        self.stopping = asyncio.Event()
+
+        # HTTP sessions, created by setup()
+        self.connections = None
+
+        # GET requests currently waiting for a response
+        self._inflight = dict()
+
+        # Optional on-disk response cache
+        self.cache = None
+
+        # Optional traffic recorder and player
+        self.recorder = None
+        self.player = None
+
+        # Optional scheduler of likes, comments and follows
+        self.scheduler = None
+        self.unfollow_budget = None
+
+        # Number of 429 responses received, in total and by watched request
+        self.throttled = 0
+        self._throttled_requests = dict()
+
+        # Page sizes of the paginated feeds by query type
+        self.page_sizers = dict()
+
+        # Whether captions are indexed for full-text search
+        self.fts = False
+
+        # Background update of the followers and following lists
+        self.followers_ready = asyncio.Event()
+        self.followers_synced = False
+        self._sync_task = None
 
     async def http_request(
         self, method, url,
         headers=None, params=None, data=None, response_type="text"
     ):
-        await asyncio.sleep(self.settings['connection']["wait_time"])
+        """
+        Sends an HTTP request. Identical GET requests issued while one is
+        already in flight don't hit the server again: they wait for the
+        pending one and share its response, which mustn't be modified.
+        If the response cache is active, GET responses are served from it
+        while they are fresh.
+
+        Args:
+            method: [String] Either "GET" or "POST".
+            url: [String] The requested URL.
+            headers: [Dict] Additional headers.
+            params: [String or Dict] The query parameters.
+            data: [Dict] The body of a POST request.
+            response_type: [String] Either "text" or "json".
 
+        Returns:
+            The response body as a string or as a dictionary.
+        """
+
+        if method != "GET":
+            return await self._http_request(
+                method,
+                url,
+                headers=headers,
+                params=params,
+                data=data,
+                response_type=response_type
+            )
+
+        request_key = utils.request_key(method, url, params)
+        key = (request_key, response_type)
         try:
-            if method == "GET":
-                r = await self.session.get(
-                    url,
-                    headers=headers,
-                    params=params
-                )
-                logger.debug(f"[GET] {r.url}")
-            elif method == "POST":
-                r = await self.session.post(
+            future = self._inflight[key]
+        except KeyError:
+            future = asyncio.ensure_future(
+                self._cached_http_request(
+                    request_key,
                     url,
                     headers=headers,
-                    data=data
+                    params=params,
+                    response_type=response_type
                 )
-                logger.debug(f"[POST] {r.url}")
-            else:
-                raise ValueError(f"Invalid HTTP method: {method}")
+            )
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._inflight.pop(key, None))
+        else:
+            logger.debug(f"[GET] {url} already in flight.")
+
+        # A cancelled caller mustn't cancel the request for the others
+        return await asyncio.shield(future)
+
+    async def _cached_http_request(
+        self, request_key, url,
+        headers=None, params=None, response_type="text"
+    ):
+        if self.cache is not None:
+            res = await self.cache.get(request_key, response_type)
+            if res is not None:
+                logger.debug(f"[GET] {url} served from cache.")
+                return res
+
+        res = await self._http_request(
+            "GET",
+            url,
+            headers=headers,
+            params=params,
+            response_type=response_type
+        )
+
+        if self.cache is not None:
+            await self.cache.set(request_key, response_type, res)
+        return res
+
+    async def _http_request(
+        self, method, url,
+        headers=None, params=None, data=None, response_type="text"
+    ):
+        await asyncio.sleep(self.settings['connection']["wait_time"])
+
+        try:
+            r = await self._fetch(
+                method,
+                url,
+                headers=headers,
+                params=params,
+                data=data
+            )
+            logger.debug(f"[{method}] {r.url}")
 
         except ClientConnectorError:
             logger.error("Could not reach the server. Retrying in 30 seconds.")
             await asyncio.sleep(30)
-            return await self.http_request(
+            return await self._http_request(
                 method,
                 url,
                 headers=headers,
@@ -83,22 +184,30 @@ class Piggy:
                     self.settings['connection']["wait_time"] -= 1
 
                 if response_type == "text":
-                    res = await r.text()
-                    logger.debug(res)
-                    return res
+                    res = r.text
                 elif response_type == "json":
-                    res = await r.json()
-                    logger.debug(res)
-                    return res
+                    res = json.loads(r.text)
                 else:
                     raise ValueError(f"Invalid response type: {response_type}")
+
+                log.log_body(
+                    logger,
+                    res,
+                    limit=self.settings["logging"]["body_limit"],
+                    sample_rate=self.settings["logging"]["body_sample_rate"]
+                )
+                return res
             elif r.status == 429:
                 # Unsuccessfull request: increase retry time
+                self.throttled += 1
+                key = utils.request_key(method, url, params)
+                if key in self._throttled_requests:
+                    self._throttled_requests[key] += 1
                 self.settings['connection']["wait_time"] += 1
                 logger.warning(
                     f"""Too many requests! Retrying in {self.settings['connection']['wait_time']} seconds."""
                 )
-                return await self.http_request(
+                return await self._http_request(
                     method,
                     url,
                     headers=headers,
@@ -109,18 +218,79 @@ class Piggy:
             else:
                 logger.error(f"Response status: {r.status}")
                 logger.error(f"Response headers: {r.headers}")
-                logger.error(await r.text())
+                logger.error(r.text)
                 raise ValueError(f"Response error: {r.status}")
 
-    async def setup(self, settings_path="settings.json"):
-        logger.info("Loading settings...")
+    async def _fetch(self, method, url, headers=None, params=None, data=None):
+        """
+        Sends a request, or replays it, and reads the whole response.
+        """
+
+        if self.player is not None:
+            return await self.player.replay(method, url, params)
 
-        # Load settings
+        if method == "GET":
+            request = self.session.get(url, headers=headers, params=params)
+        elif method == "POST":
+            request = self.session.post(url, headers=headers, data=data)
+        else:
+            raise ValueError(f"Invalid HTTP method: {method}")
+
+        start = time.monotonic()
+        async with request as r:
+            res = Response(
+                r.status,
+                r.reason,
+                r.headers,
+                await r.text(),
+                str(r.url)
+            )
+        elapsed = time.monotonic() - start
+
+        if self.recorder is not None:
+            await self.recorder.record(method, url, params, res, elapsed)
+        return res
+
+    def load_settings(self, settings_path="settings.json"):
         with open(settings_path) as f:
             self.settings = json.loads(
                 regex.sub(r"#.+$", "", f.read(), flags=regex.MULTILINE)
             )
 
+    def setup_logging(self):
+        """
+        Starts the logging pipeline configured in the "logging" settings.
+        """
+
+        log_settings = {
+            "path": "./piggy.log",
+            "max_size": 5*1024*1024,
+            "backup_count": 3,
+            "console_level": "INFO",
+            "file_level": "DEBUG",
+            "body_limit": 1000,
+            "body_sample_rate": 1.0
+        }
+        log_settings.update(self.settings.get("logging", {}))
+        self.settings["logging"] = log_settings
+        log.setup_logging(
+            path=log_settings["path"],
+            max_bytes=log_settings["max_size"],
+            backup_count=log_settings["backup_count"],
+            console_level=getattr(
+                logging, log_settings["console_level"].upper()
+            ),
+            file_level=getattr(logging, log_settings["file_level"].upper())
+        )
+
+    async def setup(self, settings_path="settings.json"):
+        # Load settings, unless they were already loaded
+        if self.settings is None:
+            self.load_settings(settings_path)
+
+        self.setup_logging()
+        logger.info("Settings loaded.")
+
         # Load comments list for photos
         with open("comments/pic_comments.txt") as f:
             comments = f.readlines()
@@ -131,21 +301,163 @@ class Piggy:
             comments = f.readlines()
         self.video_comments_list = [x.strip() for x in comments]
 
-        # Initialize the asynchronous http session
-        headers = {
-            "DNT": "1",
-            "Host": "www.instagram.com",
-            "Upgrade-Insecure-Requests": "1",
-            "User-Agent": self.settings["connection"]["user_agent"]
+        # Limit the number of concurrent downloads
+        download_settings = {
+            "path": "./images",
+            "concurrency": 8,
+            "per_media": 4
         }
-        timeout = aiohttp.ClientTimeout(
-            total=self.settings["connection"]["timeout"]
+        download_settings.update(self.settings.get("download", {}))
+        self.settings["download"] = download_settings
+        self.download_semaphore = asyncio.Semaphore(
+            download_settings["concurrency"]
         )
-        self.session = aiohttp.ClientSession(headers=headers, timeout=timeout)
+
+        # Initialize the asynchronous http sessions
+        self.connections = ConnectionManager(self.settings["connection"])
+        self.session = self.connections.api
         logger.info("Session initialized.")
 
-        # Get the csrf token. It is needed to log in
-        self.csrf_token = await self._getCsrfTokenFromForm()
+        # Initialize the traffic recorder or player
+        recording_settings = {
+            "mode": "off",
+            "path": "./recording.jsonl",
+            "time_scale": 1.0
+        }
+        recording_settings.update(self.settings.get("recording", {}))
+        self.settings["recording"] = recording_settings
+        if recording_settings["mode"] == "record":
+            self.recorder = Recorder(recording_settings["path"])
+            await self.recorder.open()
+        elif recording_settings["mode"] == "replay":
+            self.player = Player(
+                recording_settings["path"],
+                self.session.cookie_jar,
+                time_scale=recording_settings["time_scale"]
+            )
+            self.player.load()
+        elif recording_settings["mode"] != "off":
+            raise ValueError(
+                f"Invalid recording mode: {recording_settings['mode']}"
+            )
+
+        if self.player is None and self.settings["connection"].get("prewarm", False):
+            await self.connections.prewarm()
+
+        # Initialize the response cache
+        cache_settings = {
+            "active": False,
+            "path": "./cache.db",
+            "max_size": 50*1024*1024,
+            "ttl": {
+                "/accounts/": 0,
+                "/graphql/query/": 600,
+                "/p/": 3600,
+                "default": 86400
+            }
+        }
+        user_cache_settings = dict(self.settings.get("cache", {}))
+        # Custom times to live are added to the default ones
+        cache_settings["ttl"].update(user_cache_settings.pop("ttl", {}))
+        cache_settings.update(user_cache_settings)
+        self.settings["cache"] = cache_settings
+        if cache_settings["active"]:
+            self.cache = ResponseCache(
+                path=cache_settings["path"],
+                max_size=cache_settings["max_size"],
+                ttl=cache_settings["ttl"]
+            )
+            await self.cache.open()
+            logger.info("Response cache initialized.")
+
+        # Reuse the last session if it's still valid, otherwise get the csrf
+        # token. It is needed to log in. Recordings always start with a full
+        # login so that they can be replayed from scratch
+        session_settings = {
+            "persist": True,
+            "path": "./session.json"
+        }
+        session_settings.update(self.settings.get("session", {}))
+        self.settings["session"] = session_settings
+        self.logged_in = False
+        if (
+            session_settings["persist"]
+            and self.player is None
+            and self.recorder is None
+        ):
+            self.logged_in = await self._restore_session()
+        if not self.logged_in:
+            self.csrf_token = await self._getCsrfTokenFromForm()
+
+    async def _restore_session(self):
+        """
+        Loads the cookies saved by the last login and checks that the session
+        is still valid.
+
+        Returns:
+            True if the session was restored, False otherwise.
+        """
+
+        path = self.settings["session"]["path"]
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if saved.get("username") != self.settings["user"]["username"]:
+            return False
+
+        self.session.cookie_jar.update_cookies(
+            saved["cookies"],
+            URL("https://www.instagram.com/")
+        )
+
+        # Cheap probe: the account page is only returned to logged in users.
+        # Whatever goes wrong, a full login is still possible
+        try:
+            res = await self.http_request(
+                "GET",
+                "https://www.instagram.com/accounts/edit/",
+                params="__a=1",
+                response_type="json"
+            )
+            valid = "form_data" in res
+            csrf_token = utils.cookies_dict(
+                self.session.cookie_jar
+            )["csrftoken"]
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug(f"Session probe failed: {e!r}")
+            valid = False
+
+        if not valid:
+            logger.info("Saved session expired.")
+            self.session.cookie_jar.clear()
+            return False
+
+        self.id = saved["id"]
+        self.csrf_token = csrf_token
+        logger.info("Session restored.")
+        return True
+
+    def _save_session(self):
+        """
+        Saves the cookies of the current session. The file is readable by the
+        owner only since the cookies give access to the account.
+        """
+
+        path = self.settings["session"]["path"]
+        saved = {
+            "username": self.settings["user"]["username"],
+            "id": self.id,
+            "cookies": utils.cookies_dict(self.session.cookie_jar)
+        }
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(saved, f)
+        os.chmod(path, 0o600)
 
     async def _getCsrfTokenFromForm(self):
         # Get login page and find the csrf token
@@ -161,6 +473,19 @@ class Piggy:
         )[0]
 
     async def login(self):
+        if not self.logged_in:
+            await self._login()
+
+        # Initialize the database
+        await self._init_database()
+
+        # Update the followers and following lists in the background
+        self._sync_task = asyncio.ensure_future(self._sync_followers())
+
+        # Start the action scheduler
+        await self._init_scheduler()
+
+    async def _login(self):
         payload = {
             "username": self.settings["user"]["username"],
             "password": self.settings["user"]["password"]
@@ -180,6 +505,7 @@ class Piggy:
         if res["authenticated"]:
             logger.info("Logged in!")
             self.id = res["userId"]
+            self.logged_in = True
 
         elif res["message"] == "checkpoint_required":
             logger.info("Checkpoint required.")
@@ -198,121 +524,230 @@ class Piggy:
         cookies = utils.cookies_dict(self.session.cookie_jar)
         self.csrf_token = cookies["csrftoken"]
 
-        # Initialize the database
-        await self._init_database()
+        # Replayed cookies must not replace the saved session
+        if (
+            self.logged_in
+            and self.settings["session"]["persist"]
+            and self.player is None
+        ):
+            self._save_session()
 
     async def _init_database(self):
         logger.info("Checking database...")
-        # Connect to the local database and look for the table names
         async with aiosqlite.connect("./piggy.db") as db:
-            logger.debug("Checking table: pics")
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS pics (
-                    id INT,
-                    height INT,
-                    width INT,
-                    url TEXT,
-                    tags TEXT
-                )
-                """
+            version = await migrate(db)
+            logger.debug(f"Database schema version: {version}")
+
+            c = await db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name='pics_fts'"
             )
+            self.fts = await c.fetchone() is not None
 
-            logger.debug("Checking table: users")
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS users (
-                    id TEXT,
-                    username TEXT,
-                    ts_follower INTEGER,
-                    ts_following INTEGER,
-                    follower BOOL,
-                    following BOOL
+    async def _sync_followers(self):
+        """
+        Updates the follower and following flags of the users table. It runs
+        in the background: whatever relies on the flags must wait for
+        "followers_ready" to be set, and check "followers_synced" if stale
+        flags are not acceptable.
+        """
+
+        try:
+            await self._update_followers()
+            self.followers_synced = True
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Couldn't update followers and following lists.")
+        finally:
+            self.followers_ready.set()
+
+    async def _update_followers(self):
+        logger.info("Updating followers and following lists.")
+
+        # Fetch both lists before touching the database
+        followers, following = await asyncio.gather(
+            self._user_nodes("followers"),
+            self._user_nodes("following")
+        )
+
+        async with aiosqlite.connect("./piggy.db") as db:
+            now = int(time.time())
+
+            # Users who started following since the last update. If Piggy
+            # followed them first, they followed back
+            c = await db.execute("SELECT id FROM users WHERE follower=1")
+            previous = {row[0] for row in await c.fetchall()}
+            if previous:
+                gained = [
+                    int(user["id"]) for user in followers
+                    if int(user["id"]) not in previous
+                ]
+                await analytics.count(db, "new_follower", now, len(gained))
+                for i in range(0, len(gained), 500):
+                    chunk = gained[i:i+500]
+                    c = await db.execute(
+                        f"""
+                        SELECT ts_followed FROM users
+                        WHERE following=1 AND ts_followed IS NOT NULL
+                        AND id IN ({",".join("?" * len(chunk))})
+                        """,
+                        chunk
+                    )
+                    for ts_followed, in await c.fetchall():
+                        await analytics.follow_back(db, ts_followed, now)
+
+            # Store what changed since the last update
+            for relation, users in [("followers", followers), ("following", following)]:
+                gained, lost = await history.record(
+                    db,
+                    relation,
+                    [user["id"] for user in users],
+                    now
+                )
+                logger.info(
+                    f"{relation.capitalize()}: {len(gained)} gained, {len(lost)} lost."
                 )
-                """
-            )
 
-            logger.debug("Checking table: likes")
-            await db.execute(
+            await db.execute("UPDATE users SET follower=0, following=0")
+
+            await db.executemany(
                 """
-                CREATE TABLE IF NOT EXISTS likes (
-                    id INTEGER,
-                    ts INTEGER
-                )
+                INSERT INTO users VALUES(?,?,?,NULL,1,0,NULL)
+                ON CONFLICT(id) DO UPDATE SET
+                username=excluded.username, follower=1,
+                ts_follower=COALESCE(ts_follower, excluded.ts_follower)
+                """,
+                [(user["id"], user["username"], now) for user in followers]
+            )
+            await db.executemany(
                 """
+                INSERT INTO users VALUES(?,?,NULL,?,0,1,NULL)
+                ON CONFLICT(id) DO UPDATE SET
+                username=excluded.username, following=1,
+                ts_following=COALESCE(ts_following, excluded.ts_following)
+                """,
+                [(user["id"], user["username"], now) for user in following]
             )
 
-            logger.debug("Checking table: comments")
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS comments (
-                    id INTEGER,
-                    ts INTEGER,
-                    comment TEXT
-                )
+            await db.commit()
+
+        logger.info("Followers and following lists updated.")
+
+    async def _init_scheduler(self):
+        scheduler_settings = {
+            "active": False,
+            "max_pending": 1000,
+            "budgets": {
+                "like": {"hourly": 60, "daily": 1000},
+                "comment": {"hourly": 10, "daily": 150},
+                "follow": {"hourly": 20, "daily": 300},
+                "unfollow": {"hourly": 30, "daily": 500}
+            }
+        }
+        scheduler_settings.update(self.settings.get("scheduler", {}))
+        self.settings["scheduler"] = scheduler_settings
+        budgets = dict(scheduler_settings["budgets"])
+
+        # Unfollows are always paced, with or without the scheduler. Their
+        # past hour counters are a close enough history
+        limits = budgets.pop("unfollow", {"hourly": 30, "daily": 500})
+        self.unfollow_budget = Budget(limits["hourly"], limits["daily"])
+        async with aiosqlite.connect("./piggy.db") as db:
+            rows = await db.execute(
                 """
+                SELECT hour, count FROM stats_activity
+                WHERE action='unfollow' AND hour>=? ORDER BY hour
+                """,
+                ((int(time.time()) - 86400) // 3600,)
             )
+            for hour, count in await rows.fetchall():
+                for _ in range(count):
+                    self.unfollow_budget.add(hour * 3600)
 
-            logger.info("Updating followers and following lists.")
-            await db.execute("UPDATE users SET follower=0, following=1")
+        if not scheduler_settings["active"]:
+            return
 
-            for username in await self.followers():
-                await db.execute(
-                    "UPDATE users SET follower=0 WHERE username=?",
-                    (username,)
-                )
+        self.scheduler = ActionScheduler(
+            budgets,
+            max_pending=scheduler_settings["max_pending"]
+        )
 
-            for username in await self.following():
-                await db.execute(
-                    "UPDATE users SET following=1 WHERE username=?",
-                    (username,)
-                )
+        # Count the actions of the last 24 hours against the budgets
+        since = int(time.time()) - 86400
+        queries = {
+            "like": "SELECT ts FROM likes WHERE ts>? ORDER BY ts",
+            "comment": "SELECT ts FROM comments WHERE ts>? ORDER BY ts",
+            "follow": "SELECT ts_followed FROM users WHERE ts_followed>? ORDER BY ts_followed"
+        }
+        async with aiosqlite.connect("./piggy.db") as db:
+            for action, query in queries.items():
+                if action not in self.scheduler.budgets:
+                    continue
+                rows = await db.execute(query, (since,))
+                for row in await rows.fetchall():
+                    self.scheduler.budgets[action].add(row[0])
 
-            await db.commit()
+        self.scheduler.start()
+        logger.info("Action scheduler started.")
+
+    async def _perform(self, action, media, fn, *args):
+        """
+        Executes an action right away or, if the scheduler is active, queues
+        it. Media with fewer likes and comments are given a higher priority
+        since their owners are more likely to notice the interaction.
+        """
+
+        if self.scheduler is None or action not in self.scheduler.budgets:
+            await fn(*args)
+        elif self.scheduler.submit(
+            action, args[0], media.likes + media.comments, fn, *args
+        ):
+            logger.info(f"{action.capitalize()} scheduled.")
 
     async def followers(self, username=None):
-        followers = []
+        return [
+            user["username"]
+            for user in await self._user_nodes("followers", username)
+        ]
 
-        if username is None:
-            id = self.id
-        else:
-            user = await self.get_user_by_username(username)
-            id = user["graphql"]["user"]["id"]
+    async def following(self, username=None):
+        return [
+            user["username"]
+            for user in await self._user_nodes("following", username)
+        ]
 
-        params = {
-            "query_hash": "37479f2b8209594dde7facb0d904896a",
-            "variables": json.dumps({"id": str(id), "first": 50})
-        }
-        has_next_page = True
-        while has_next_page:
-            res = await self.http_request(
-                "GET",
-                "https://www.instagram.com/graphql/query/",
-                params=params,
-                response_type="json"
-            )
+    async def _user_nodes(self, relation, username=None):
+        """
+        Retrieves the followers or the following list of a user.
 
-            has_next_page = res["data"]["user"]["edge_followed_by"]["page_info"]["has_next_page"]
-            end_cursor = res["data"]["user"]["edge_followed_by"]["page_info"]["end_cursor"]
-            params["variables"] = json.dumps(
-                {"id": str(id), "first": 50, "after": end_cursor}
-            )
+        Args:
+            relation: [String] Either "followers" or "following".
+            username: [String] The user. If None, the logged in user.
 
-            for user in res["data"]["user"]["edge_followed_by"]["edges"]:
-                followers.append(user["node"]["username"])
-        return followers
+        Returns:
+            A list of dictionaries with the "id" and the "username" of every
+            user in the list.
+        """
 
-    async def following(self, username=None):
-        following = []
+        if relation == "followers":
+            query_hash = "37479f2b8209594dde7facb0d904896a"
+            edge = "edge_followed_by"
+        elif relation == "following":
+            query_hash = "58712303d941c6855d4e888c5f0cd22f"
+            edge = "edge_follow"
+        else:
+            raise ValueError(f"Invalid relation: {relation}")
+
+        users = []
 
         if username is None:
             id = self.id
         else:
             user = await self.get_user_by_username(username)
-            id = user["graphql"]["user"]["id"]
+            id = user["id"]
 
         params = {
-            "query_hash": "58712303d941c6855d4e888c5f0cd22f",
+            "query_hash": query_hash,
             "variables": json.dumps({"id": str(id), "first": 50})
         }
         has_next_page = True
@@ -324,17 +759,25 @@ class Piggy:
                 response_type="json"
             )
 
-            has_next_page = res["data"]["user"]["edge_follow"]["page_info"]["has_next_page"]
-            end_cursor = res["data"]["user"]["edge_follow"]["page_info"]["end_cursor"]
+            has_next_page = res["data"]["user"][edge]["page_info"]["has_next_page"]
+            end_cursor = res["data"]["user"][edge]["page_info"]["end_cursor"]
             params["variables"] = json.dumps(
                 {"id": str(id), "first": 50, "after": end_cursor}
             )
 
-            for user in res["data"]["user"]["edge_follow"]["edges"]:
-                following.append(user["node"]["username"])
-        return following
+            for user in res["data"]["user"][edge]["edges"]:
+                users.append(
+                    {
+                        "id": user["node"]["id"],
+                        "username": user["node"]["username"]
+                    }
+                )
+        return users
 
-    async def feed(self, explore=True, users=[], hashtags=[], locations=[]):
+    async def feed(
+        self, explore=True, users=[], hashtags=[], locations=[],
+        keep_node=False, concurrency=4, prefetch=50, eligible=None
+    ):
         """
         Generates a feed based on the passed parameters. Multiple parameters
         can be passed at the same time.
@@ -348,139 +791,182 @@ class Piggy:
             to the feed.
             locations: [List of locations ids] Media with those locations will
             be added to the feed.
+            keep_node: [Bool] If True the raw GraphQL node is retained in each
+            yielded media.
+            concurrency: [Int] Maximum number of sources fetched at once.
+            Sources yielding more new media are fetched more often.
+            prefetch: [Int] Maximum number of media loaded in advance.
+            eligible: A function that returns False for the media that must
+            not be yielded. Sources yielding more eligible media are fetched
+            more often.
 
         Retruns:
-            Yields a media from the generated feed.
+            Yields a Media from the generated feed. Duplicates are discarded.
         """
 
-        # Initialize asynchronous queue where the feed elements will be
-        # temporarely stored
-        q = asyncio.Queue()
-
+        sources = []
         if explore:
-            # Add the "explore" feed to the queue
-            asyncio.ensure_future(self._explore_feed(q))
-        if len(users):
-            # Add all the media from the given users to the queue
-            for user in users:
-                asyncio.ensure_future(self._user_feed(q, user))
-        if len(hashtags):
-            # Add all the media from the given hashtags to the queue
-            for hashtag in hashtags:
-                asyncio.ensure_future(self._hashtag_feed(q, hashtag))
-        if len(locations):
-            # Add all the media from the given locations to the queue
-            for location in locations:
-                asyncio.ensure_future(self._location_feed(q, location))
-
-        # Keep on yielding media while more is loaded
-        while 1:
-            while not q.empty():
-                yield await q.get()
-            await asyncio.sleep(1e-12)
-
-    async def _explore_feed(self, q):
-        params = {
-            "query_hash": "ecd67af449fb6edab7c69a205413bfa7",
-            "variables": json.dumps({"first": 24})
-        }
-        has_next_page = True
-        while has_next_page:
-            res = await self.http_request(
-                "GET",
-                "https://www.instagram.com/graphql/query/",
-                params=params,
-                response_type="json"
+            sources.append(("explore", self._explore_feed(keep_node)))
+        for user in users:
+            sources.append((f"user {user}", self._user_feed(user, keep_node)))
+        for hashtag in hashtags:
+            sources.append(
+                (f"#{hashtag}", self._hashtag_feed(hashtag, keep_node))
             )
-
-            has_next_page = res["data"]["user"]["edge_web_discover_media"]["page_info"]["has_next_page"]
-            end_cursor = res["data"]["user"]["edge_web_discover_media"]["page_info"]["end_cursor"]
-            params["variables"] = json.dumps(
-                {"first": 50, "after": end_cursor}
+        for location in locations:
+            sources.append(
+                (f"location {location}", self._location_feed(location, keep_node))
             )
 
-            for media in res["data"]["user"]["edge_web_discover_media"]["edges"]:
-                await q.put(media["node"])
-
-    async def _user_feed(self, q, user):
-        user = await self.get_user_by_usernameUsername(user)
-        id = user["id"]
-
-        params = {
-            "query_hash": "a5164aed103f24b03e7b7747a2d94e3c",
-            "variables": json.dumps({"id": id, "first": 24})
-        }
-        has_next_page = True
-        while has_next_page:
-            res = await self.http_request(
-                "GET",
-                "https://www.instagram.com/graphql/query/",
-                params=params,
-                response_type="json"
-            )
-
-            has_next_page = res["data"]["user"]["edge_owner_to_timeline_media"]["page_info"]["has_next_page"]
-            end_cursor = res["data"]["user"]["edge_owner_to_timeline_media"]["page_info"]["end_cursor"]
-            params["variables"] = json.dumps(
-                {"id": id, "first": 50, "after": end_cursor}
-            )
+        # Initialize asynchronous queue where the feed elements will be
+        # temporarely stored. When it's full the sources wait for the consumer
+        q = asyncio.Queue(maxsize=prefetch)
+
+        scheduler = SourceScheduler(
+            sources,
+            q,
+            concurrency=concurrency,
+            eligible=eligible
+        )
 
-            for media in res["data"]["user"]["edge_web_discover_media"]["edges"]:
-                await q.put(media["node"])
+        async def run():
+            try:
+                await scheduler.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Feed failed.")
+            # Signal the end of the feed
+            await q.put(None)
+
+        task = asyncio.ensure_future(run())
+        try:
+            while 1:
+                media = await q.get()
+                if media is None:
+                    break
+                yield media
+        finally:
+            # The consumer stopped: stop the sources as well
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _paginate(
+        self, query_type, query_hash, variables, path, keep_node=False
+    ):
+        """
+        Fetches the pages of a paginated GraphQL query. The page size is
+        chosen by the PageSizer of the query type.
 
-    async def _hashtag_feed(self, q, hashtag):
-        count = 0
-        params = {
-            "query_hash": "1780c1b186e2c37de9f7da95ce41bb67",
-            "variables": json.dumps({"tag_name": hashtag, "first": count})
-        }
-        has_next_page = True
-        while has_next_page:
-            res = await self.http_request(
-                "GET",
-                "https://www.instagram.com/graphql/query/",
-                params=params,
-                response_type="json"
-            )
+        Args:
+            query_type: [String] Name of the query, e.g. "hashtag".
+            query_hash: [String] The GraphQL query hash.
+            variables: [Dict] The query variables, except "first" and "after".
+            path: [List] Keys leading to the media edge in the response.
+            keep_node: [Bool] If True the raw GraphQL node is retained.
 
-            has_next_page = res["data"]["hashtag"]["edge_hashtag_to_media"]["page_info"]["has_next_page"]
-            end_cursor = res["data"]["hashtag"]["edge_hashtag_to_media"]["page_info"]["end_cursor"]
-            count += 1
-            params["variables"] = json.dumps(
-                {"tag_name": hashtag, "first": count, "after": end_cursor}
-            )
+        Returns:
+            Yields the media of a page as a list.
+        """
 
-            for media in res["data"]["hashtag"]["edge_hashtag_to_media"]["edges"]:
-                await q.put(media["node"])
+        try:
+            sizer = self.page_sizers[query_type]
+        except KeyError:
+            sizer = self.page_sizers[query_type] = PageSizer()
 
-    async def _location_feed(self, q, location_id):
-        count = 0
-        params = {
-            "query_hash": "1b84447a4d8b6d6d0426fefb34514485",
-            "variables": json.dumps({"id": str(location_id), "first": 50})
-        }
+        end_cursor = None
+        failures = 0
         has_next_page = True
         while has_next_page:
-            res = await self.http_request(
-                "GET",
-                "https://www.instagram.com/graphql/query/",
-                params=params,
-                response_type="json"
-            )
-
-            has_next_page = res["data"]["location"]["edge_location_to_media"]["page_info"]["has_next_page"]
-            end_cursor = res["data"]["location"]["edge_location_to_media"]["page_info"]["end_cursor"]
-            count += 1
-            params["variables"] = json.dumps(
-                {
-                    "id": str(location_id),
-                    "first": 50,
-                    "after": str(end_cursor)
-                }
+            first = sizer.size
+            page_variables = dict(variables, first=first)
+            if end_cursor is not None:
+                page_variables["after"] = end_cursor
+            params = {
+                "query_hash": query_hash,
+                "variables": json.dumps(page_variables)
+            }
+
+            # Only the 429s of this very request affect the page size
+            url = "https://www.instagram.com/graphql/query/"
+            key = utils.request_key("GET", url, params)
+            self._throttled_requests[key] = 0
+            try:
+                res = await self.http_request(
+                    "GET",
+                    url,
+                    params=params,
+                    response_type="json"
+                )
+            except ValueError:
+                # Retry the same page with a smaller size
+                sizer.failure()
+                failures += 1
+                if failures > 3:
+                    raise
+                await asyncio.sleep(2 ** failures)
+                continue
+            finally:
+                throttled = self._throttled_requests.pop(key, 0)
+            failures = 0
+
+            edge = res["data"]
+            for key in path:
+                edge = edge[key]
+
+            has_next_page = edge["page_info"]["has_next_page"]
+            end_cursor = edge["page_info"]["end_cursor"]
+
+            sizer.success(
+                first, len(edge["edges"]), has_next_page, throttled > 0
             )
 
-            for media in res["data"]["location"]["edge_location_to_media"]["edges"]:
-                await q.put(media["node"])
+            yield [
+                Media.from_node(media["node"], keep_node)
+                for media in edge["edges"]
+            ]
+
+    async def _explore_feed(self, keep_node=False):
+        async for page in self._paginate(
+            "explore",
+            "ecd67af449fb6edab7c69a205413bfa7",
+            {},
+            ["user", "edge_web_discover_media"],
+            keep_node
+        ):
+            yield page
+
+    async def _user_feed(self, user, keep_node=False):
+        user = await self.get_user_by_username(user)
+
+        async for page in self._paginate(
+            "user",
+            "a5164aed103f24b03e7b7747a2d94e3c",
+            {"id": user["id"]},
+            ["user", "edge_owner_to_timeline_media"],
+            keep_node
+        ):
+            yield page
+
+    async def _hashtag_feed(self, hashtag, keep_node=False):
+        async for page in self._paginate(
+            "hashtag",
+            "1780c1b186e2c37de9f7da95ce41bb67",
+            {"tag_name": hashtag},
+            ["hashtag", "edge_hashtag_to_media"],
+            keep_node
+        ):
+            yield page
+
+    async def _location_feed(self, location_id, keep_node=False):
+        async for page in self._paginate(
+            "location",
+            "1b84447a4d8b6d6d0426fefb34514485",
+            {"id": str(location_id)},
+            ["location", "edge_location_to_media"],
+            keep_node
+        ):
+            yield page
 
     async def print(self, media):
         """
@@ -495,37 +981,18 @@ class Piggy:
 
         logger.info("#--------"*3+"#")
 
-        try:
-            mediatype = media["__typename"]
-        except KeyError:
-            is_video = media["is_video"]
-            if is_video:
-                mediatype = "GraphVideo"
-            else:
-                mediatype = "GraphImage"
-            pass
-
-        likes = media["edge_liked_by"]["count"]
-        comments = media["edge_media_to_comment"]["count"]
+        mediatype = media.typename
+        likes = media.likes
+        comments = media.comments
 
-        shortcode = media["shortcode"]
-        res = await self.http_request(
-            "GET",
-            f"https://www.instagram.com/p/{shortcode}/",
-            params="__a=1",
-            response_type="json"
-        )
-
-        username = res["graphql"]["shortcode_media"]["owner"]["username"]
+        node = await self.get_media_node(media)
+        username = node["owner"]["username"]
 
         logger.info(
             f"{utils.translate_ig_media_type_to_custom(mediatype).capitalize()} by {username}\n❤️ {likes}, 💬 {comments}"
         )
-        try:
-            caption = media["edge_media_to_caption"]["edges"][0]["node"]["text"]
-        except IndexError:
-            pass
-        else:
+        caption = media.caption
+        if caption is not None:
             if len(caption) > 100:
                 logger.info(f"{caption:.100}...")
             else:
@@ -546,38 +1013,28 @@ class Piggy:
         # Check if the media has already been liked
         async with aiosqlite.connect("./piggy.db") as db:
             row = await db.execute(
-                "SELECT * FROM likes WHERE id=?",
-                (media["id"],)
+                "SELECT 1 FROM likes WHERE id=?",
+                (media.id,)
             )
             if await row.fetchone():
                 logger.info("Already liked!")
                 return
 
-        try:
-            mediatype = media["__typename"]
-        except KeyError:
-            is_video = media["is_video"]
-            if is_video:
-                mediatype = "GraphVideo"
-            else:
-                mediatype = "GraphImage"
-            pass
-        else:
-            if not mediatype in utils.translate_custom_media_type_to_ig(self.settings["like"]["media_type"]):
-                logger.info("Wrong media type. Not liked!")
-                return
+        if not media.typename in utils.translate_custom_media_type_to_ig(self.settings["like"]["media_type"]):
+            logger.info("Wrong media type. Not liked!")
+            return
 
-        likes = media["edge_liked_by"]["count"]
+        likes = media.likes
         if likes < self.settings["like"]["num_of_likes"]["min"] or likes >= self.settings["like"]["num_of_likes"]["max"]:
             logger.info("Too many or too few likes. Not liked!")
             return
-        comments = media["edge_media_to_comment"]["count"]
+        comments = media.comments
         if comments < self.settings["like"]["num_of_comments"]["min"] or comments >= self.settings["like"]["num_of_comments"]["max"]:
             logger.info("Too many or too few comments. Not liked!")
             return
 
         if self.settings["like"]["rate"] / 100 > random():
-            await self._like(media["id"])
+            await self._perform("like", media, self._like, media.id)
         else:
             logger.info("Not liked!")
 
@@ -595,10 +1052,13 @@ class Piggy:
         )
 
         async with aiosqlite.connect("./piggy.db") as db:
-            await db.execute(
-                "INSERT INTO likes VALUES(?,?)",
-                (id, int(time.time()))
+            now = int(time.time())
+            c = await db.execute(
+                "INSERT OR IGNORE INTO likes VALUES(?,?)",
+                (id, now)
             )
+            if c.rowcount:
+                await analytics.count(db, "like", now)
             await db.commit()
 
         logger.info("Liked!")
@@ -617,7 +1077,8 @@ class Piggy:
         )
 
         async with aiosqlite.connect("./piggy.db") as db:
-            await db.execute("INSERT INTO likes WHERE id=?", (id,))
+            await db.execute("DELETE FROM likes WHERE id=?", (id,))
+            await analytics.count(db, "unlike", int(time.time()))
             await db.commit()
 
         logger.info("Unliked!")
@@ -634,37 +1095,28 @@ class Piggy:
             None
         """
 
-        if media["comments_disabled"]:
+        if media.comments_disabled:
             logger.info("Comments disabled.")
             return
 
         if self.settings["comment"]["only_once"]:
             async with aiosqlite.connect("./piggy.db") as db:
                 row = await db.execute(
-                    "SELECT * FROM comments WHERE id=?",
-                    (media["id"],)
+                    "SELECT 1 FROM comments WHERE id=?",
+                    (media.id,)
                 )
-                if await row.fetchone() is None:
+                if await row.fetchone() is not None:
                     logger.info("Already commented.")
                     return
 
-        try:
-            mediatype = media["__typename"]
-        except KeyError:
-            is_video = media["is_video"]
-            if is_video:
-                mediatype = "GraphVideo"
-            else:
-                mediatype = "GraphImage"
-            pass
-        else:
-            if not mediatype in utils.translate_custom_media_type_to_ig(self.settings["comment"]["media_type"]):
-                return
+        mediatype = media.typename
+        if not mediatype in utils.translate_custom_media_type_to_ig(self.settings["comment"]["media_type"]):
+            return
 
-        likes = media["edge_liked_by"]["count"]
+        likes = media.likes
         if likes < self.settings["comment"]["num_of_likes"]["min"] or likes >= self.settings["comment"]["num_of_likes"]["max"]:
             return
-        comments = media["edge_media_to_comment"]["count"]
+        comments = media.comments
         if comments < self.settings["comment"]["num_of_comments"]["min"] or comments >= self.settings["comment"]["num_of_comments"]["max"]:
             return
 
@@ -677,7 +1129,9 @@ class Piggy:
                 comment = self.video_comments_list[
                     randint(0, len(self.video_comments_list)-1)
                 ]
-            await self._comment(media["id"], comment)
+            await self._perform(
+                "comment", media, self._comment, media.id, comment
+            )
         else:
             logger.info("Not commented!")
 
@@ -699,10 +1153,12 @@ class Piggy:
         )
 
         async with aiosqlite.connect("./piggy.db") as db:
+            now = int(time.time())
             await db.execute(
                 "INSERT INTO comments VALUES(?,?,?)",
-                (id, int(time.time()), comment)
+                (id, now, comment)
             )
+            await analytics.count(db, "comment", now)
             await db.commit()
 
         logger.info("Comment posted!")
@@ -720,7 +1176,7 @@ class Piggy:
         """
 
         if self.settings["follow"]["rate"] / 100 > random():
-            await self._follow(media["owner"]["id"])
+            await self._perform("follow", media, self._follow, media.owner_id)
         else:
             logger.info("Not followed!")
 
@@ -737,29 +1193,157 @@ class Piggy:
             headers=headers
         )
 
+        # Don't let the followers update overwrite this follow
+        await self.followers_ready.wait()
+
         async with aiosqlite.connect("./piggy.db") as db:
-            c = await db.execute("SELECT * FROM users WHERE id=?", (id,))
-            if c.rowcount:
+            c = await db.execute(
+                "SELECT following FROM users WHERE id=?",
+                (id,)
+            )
+            row = await c.fetchone()
+
+            now = int(time.time())
+            await db.execute(
+                """
+                INSERT INTO users VALUES(?,NULL,NULL,?,0,1,?)
+                ON CONFLICT(id) DO UPDATE SET
+                ts_following=excluded.ts_following, following=1,
+                ts_followed=CASE WHEN following THEN ts_followed
+                ELSE excluded.ts_followed END
+                """,
+                (id, now, now)
+            )
+            if row is None or not row[0]:
+                await analytics.count(db, "follow", now)
+                await analytics.follow(db, now)
+
+            await db.commit()
+
+        logger.info("Follow request sent!")
+
+    async def unfollow(self, id):
+        """
+        Unfollows a user within the unfollow budget.
+
+        Args:
+            id: The id of the user to unfollow.
+
+        Returns:
+            None
+        """
+
+        if self.unfollow_budget.disabled:
+            logger.warning(f"Unfollowing is disabled: {id} not unfollowed.")
+            return
+
+        await asyncio.sleep(self.unfollow_budget.delay(time.time()))
+        self.unfollow_budget.add(time.time())
+
+        await self._unfollow(id)
+
+    async def unfollow_non_followers(self):
+        """
+        Unfollows every user who doesn't follow back after the grace period.
+        Candidates are read in batches ordered by follow time and the position
+        reached is saved after every unfollow, so an interrupted cleanup is
+        resumed where it stopped.
+
+        Returns:
+            The number of users unfollowed.
+        """
+
+        settings = {
+            "grace_period": "3d",
+            "batch_size": 100
+        }
+        settings.update(self.settings["following"])
+
+        if self.unfollow_budget.disabled:
+            logger.info("Unfollowing is disabled.")
+            return 0
+
+        # Stale flags would unfollow users who do follow back
+        await self.followers_ready.wait()
+        if not self.followers_synced:
+            logger.error(
+                "Followers and following lists are not up to date: unfollow aborted."
+            )
+            return 0
+
+        async with aiosqlite.connect("./piggy.db") as db:
+            c = await db.execute(
+                """
+                SELECT cutoff, last_ts, last_id, done FROM jobs
+                WHERE name='unfollow_non_followers'
+                """
+            )
+            row = await c.fetchone()
+            if row is None:
+                cutoff = int(time.time()) - utils.interval_in_seconds(
+                    settings["grace_period"]
+                )
+                last_ts, last_id, done = -1, 0, 0
                 await db.execute(
-                    """
-                    UPDATE users SET
-                    ts_following=?, following=?
-                    WHERE id=?
-                    """,
-                    (int(time.time()), True, id)
+                    "INSERT INTO jobs VALUES('unfollow_non_followers',?,?,?,?)",
+                    (cutoff, last_ts, last_id, done)
                 )
+                await db.commit()
             else:
-                await db.execute(
-                    "INSERT INTO users VALUES(?,?,?,?,?)",
-                    (id, None, int(time.time()), False, True)
+                cutoff, last_ts, last_id, done = row
+                logger.info(f"Resuming unfollow: {done} users already unfollowed.")
+
+        while 1:
+            async with aiosqlite.connect("./piggy.db") as db:
+                c = await db.execute(
+                    """
+                    SELECT id, ts_following FROM users
+                    WHERE following=1 AND follower=0 AND ts_following<=?
+                    AND (ts_following>? OR (ts_following=? AND id>?))
+                    ORDER BY ts_following, id
+                    LIMIT ?
+                    """,
+                    (
+                        cutoff, last_ts, last_ts, last_id,
+                        settings["batch_size"]
+                    )
                 )
+                batch = await c.fetchall()
 
-            await db.commit()
+            if not batch:
+                break
 
-        logger.info("Follow request sent!")
+            for id, ts_following in batch:
+                if self.stopping.is_set():
+                    logger.info(f"Unfollow interrupted after {done} users.")
+                    return done
 
-    async def unfollow(self, id):
-        return
+                try:
+                    await self.unfollow(id)
+                except ValueError:
+                    logger.warning(f"Couldn't unfollow {id}.")
+                else:
+                    done += 1
+                last_ts, last_id = ts_following, id
+
+                async with aiosqlite.connect("./piggy.db") as db:
+                    await db.execute(
+                        """
+                        UPDATE jobs SET last_ts=?, last_id=?, done=?
+                        WHERE name='unfollow_non_followers'
+                        """,
+                        (last_ts, last_id, done)
+                    )
+                    await db.commit()
+
+        async with aiosqlite.connect("./piggy.db") as db:
+            await db.execute(
+                "DELETE FROM jobs WHERE name='unfollow_non_followers'"
+            )
+            await db.commit()
+
+        logger.info(f"Unfollowed {done} non followers.")
+        return done
 
     async def _unfollow(self, id):
         headers = {
@@ -774,43 +1358,214 @@ class Piggy:
             headers=headers
         )
 
+        await self.followers_ready.wait()
+
         async with aiosqlite.connect("./piggy.db") as db:
-            await db.execute(
-                "UPDATE users SET following=false WHERE id=?",
+            c = await db.execute(
+                "UPDATE users SET following=0 WHERE id=? AND following=1",
                 (id,)
             )
+            if c.rowcount:
+                await analytics.count(db, "unfollow", int(time.time()))
             await db.commit()
 
+        logger.info("Unfollowed!")
+
+    async def followers_at(self, ts, relation="followers"):
+        """
+        Reconstructs the followers or following list as it was at a given
+        time from the stored changes.
+
+        Args:
+            ts: [Int] Unix timestamp.
+            relation: [String] Either "followers" or "following".
+
+        Returns:
+            A list of (id, username) tuples. The username is None for the
+            users whose username is unknown.
+        """
+
+        async with aiosqlite.connect("./piggy.db") as db:
+            ids = await history.snapshot(db, relation, ts)
+            usernames = dict()
+            ids = list(ids)
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                rows = await db.execute(
+                    f"""
+                    SELECT id, username FROM users
+                    WHERE id IN ({",".join("?" * len(chunk))})
+                    """,
+                    chunk
+                )
+                usernames.update(await rows.fetchall())
+        return [(id, usernames.get(id)) for id in ids]
+
+    async def follower_changes(self, since, until=None, relation="followers"):
+        """
+        Returns the users gained and lost in a time interval.
+
+        Args:
+            since: [Int] Unix timestamp of the start of the interval.
+            until: [Int] Unix timestamp of the end of the interval. If None,
+            now.
+            relation: [String] Either "followers" or "following".
+
+        Returns:
+            A list of (ts, id, username, gained) tuples sorted by time.
+        """
+
+        if until is None:
+            until = int(time.time())
+        async with aiosqlite.connect("./piggy.db") as db:
+            return await history.changes(db, relation, since, until)
+
+    async def activity(self, action, days=30, by="day"):
+        """
+        Returns the number of actions per day or per hour.
+
+        Args:
+            action: [String] One of "like", "unlike", "comment", "follow",
+            "unfollow", "new_follower".
+            days: [Int] Number of days to look back.
+            by: [String] Either "day" or "hour".
+
+        Returns:
+            A list of (period start timestamp, count) tuples.
+        """
+
+        async with aiosqlite.connect("./piggy.db") as db:
+            return await analytics.activity(
+                db,
+                action,
+                int(time.time()) - days * 86400,
+                by=by
+            )
+
+    async def follow_back_stats(self, days=30):
+        """
+        Returns the follow back rate and the average time to follow back of
+        the users followed each day.
+
+        Args:
+            days: [Int] Number of days to look back.
+
+        Returns:
+            A list of (day start timestamp, follows, followed back, follow back
+            rate, average seconds to follow back) tuples.
+        """
+
+        async with aiosqlite.connect("./piggy.db") as db:
+            return await analytics.follow_backs(
+                db,
+                int(time.time()) - days * 86400
+            )
+
+    async def export_stats(self, days=30):
+        """
+        Exports the daily activity and the follow back statistics to the
+        backups folder in the backup format.
+
+        Returns:
+            None
+        """
+
+        actions = ["like", "unlike", "comment", "follow", "unfollow", "new_follower"]
+        daily = dict()
+        for action in actions:
+            for day, n in await self.activity(action, days):
+                daily.setdefault(day, dict())[action] = n
+        rows = [
+            [day] + [daily[day].get(action, 0) for action in actions]
+            for day in sorted(daily)
+        ]
+        tables = {
+            "stats_activity": (["day"] + actions, rows),
+            "stats_follow_back": (
+                ["day", "follows", "followed_back", "rate", "avg_delay"],
+                await self.follow_back_stats(days)
+            )
+        }
+
+        for name, (header, rows) in tables.items():
+            if self.settings["backup"]["format"] == "csv":
+                await utils.to_csv(name, header, rows)
+            elif self.settings["backup"]["format"] == "json":
+                await utils.to_json(name, header, rows)
+            else:
+                logger.warning(
+                    f"""Unsupported file format: {self.settings['backup']['format']}."""
+                )
+
     async def backup(self):
         while 1:
-            logger.info("Backing up database...")
-            for table_name in ["users", "likes", "comments"]:
-                if self.settings["backup"][table_name]:
-                    async with aiosqlite.connect("./piggy.db") as db:
-                        rows = await db.execute(
-                            f"SELECT * FROM '{table_name}'"
-                        )
-                        header = [i[0] for i in rows.description]
-                        rows = await rows.fetchall()
-
-                    if self.settings["backup"]["format"] == "csv":
-                        await utils.to_csv(table_name, header, rows)
-                    elif self.settings["backup"]["format"] == "json":
-                        await utils.to_json(table_name, header, rows)
-                    else:
-                        logger.warning(
-                            f"""Unsupported file format: {self.settings['backup']['format']}."""
-                        )
-
-                await asyncio.sleep(
-                    utils.interval_in_seconds(self.settings["backup"]["every"])
-                )
+            await self.backup_once()
+            await asyncio.sleep(
+                utils.interval_in_seconds(self.settings["backup"]["every"])
+            )
+
+    async def export(self):
+        """
+        Backs up the database and the statistics once, without logging in.
+        """
+
+        await self._init_database()
+        self.settings["backup"]["stats"] = True
+        await self.backup_once()
+
+    async def backup_once(self):
+        logger.info("Backing up database...")
+        for table_name in ["users", "likes", "comments"]:
+            if self.settings["backup"][table_name]:
+                async with aiosqlite.connect("./piggy.db") as db:
+                    rows = await db.execute(
+                        f"SELECT * FROM '{table_name}'"
+                    )
+                    header = [i[0] for i in rows.description]
+                    rows = await rows.fetchall()
+
+                if self.settings["backup"]["format"] == "csv":
+                    await utils.to_csv(table_name, header, rows)
+                elif self.settings["backup"]["format"] == "json":
+                    await utils.to_json(table_name, header, rows)
+                else:
+                    logger.warning(
+                        f"""Unsupported file format: {self.settings['backup']['format']}."""
+                    )
+
+        if self.settings["backup"].get("stats", False):
+            await self.export_stats()
 
     async def close(self):
         logger.info("\nClosing session...")
+        self.stopping.set()
+
+        for query_type, sizer in self.page_sizers.items():
+            logger.info(
+                f"{query_type.capitalize()} feed: {sizer.items_per_request:.1f} media per request, page size {sizer.size}."
+            )
+
+        # Stop the followers update, letting it close its database connection
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            await asyncio.gather(self._sync_task, return_exceptions=True)
+
+        # Stop the action scheduler
+        if self.scheduler is not None:
+            await self.scheduler.stop()
 
-        # Close the http session
-        await self.session.close()
+        # Close the http sessions
+        if self.connections is not None:
+            self.connections.report()
+            await self.connections.close()
+
+        # Close the traffic recorder
+        if self.recorder is not None:
+            await self.recorder.close()
+
+        # Close the response cache
+        if self.cache is not None:
+            await self.cache.close()
 
     async def get_user_by_username(self, username):
         res = await self.http_request(
@@ -830,56 +1585,151 @@ class Piggy:
                 flags=regex.DOTALL
             )[0][:-1])["entry_data"]["ProfilePage"][0]["graphql"]["user"]
 
+    async def get_media_node(self, media):
+        """
+        Returns the raw GraphQL node of a media. If the node wasn't retained
+        when the media was parsed it is requested to the server.
+
+        Args:
+            media: The media whose node is needed.
+
+        Returns:
+            The GraphQL node as a dictionary.
+        """
+
+        try:
+            return media.node
+        except AttributeError:
+            pass
+
+        res = await self.http_request(
+            "GET",
+            f"https://www.instagram.com/p/{media.shortcode}/",
+            params="__a=1",
+            response_type="json"
+        )
+        return res["graphql"]["shortcode_media"]
+
 # -----------------------------------------------------------------------------
     async def download(self, media):
-        id = media["id"]
-        url = media["display_url"]
-        format = regex.findall(r".([a-zA-Z]+)$", url)[0]
+        """
+        Downloads a photo, a video or every photo and video of an album and
+        saves them in the database. The files of an album are downloaded
+        concurrently. The caption of an album is indexed once, with its first
+        saved file.
+
+        Args:
+            media: The media to download.
+
+        Returns:
+            None
+        """
 
-        if media["__typename"] != "GraphImage" or await self.pic_already_saved(id):
+        if await self.pic_already_saved(media.id):
             return
 
-        height = media["dimensions"]["height"]
-        width = media["dimensions"]["width"]
-        try:
-            caption = media["edge_media_to_caption"]["edges"][0]["node"]["text"]
-        except IndexError:
+        items = await self._download_items(media)
+        if media.typename == "GraphSidecar":
+            parent_id = media.id
+        else:
+            parent_id = None
+
+        caption = media.caption
+        if caption is None:
             tags = []
-            pass
         else:
-            if await self.download_pic(url, id, format):
-                logger.info(f"Caption: {caption}")
-                tags = regex.findall(r"#([\p{L}0-9_]+)", caption)
-                logger.info(f"Tags: {tags}")
+            logger.info(f"Caption: {caption}")
+            tags = regex.findall(r"#([\p{L}0-9_]+)", caption)
+            logger.info(f"Tags: {tags}")
+
+        per_media = asyncio.Semaphore(self.settings["download"]["per_media"])
+        captioned = False
+
+        async def fetch(item):
+            nonlocal captioned
+
+            if item.typename == "GraphVideo":
+                url = item.video_url
+                format = "mp4"
             else:
-                return
+                url = item.display_url
+                format = "jpg"
+            extension = regex.search(r"\.([a-zA-Z0-9]+)$", urlsplit(url).path)
+            if extension is not None:
+                format = extension.group(1)
+
+            async with per_media, self.download_semaphore:
+                if not await self.download_pic(url, item.id, format):
+                    return
+            item_caption = None if captioned else caption
+            captioned = True
+            await self.save_to_database(
+                item.id, item.typename, item.height, item.width, url, tags,
+                item_caption, parent_id
+            )
 
-        await self.save_to_database(id, type, height, width, url, tags)
+        await asyncio.gather(*[fetch(item) for item in items])
+
+    async def _download_items(self, media):
+        # Returns the media to download, requesting the details of the media
+        # when the feed node lacks the video URL or the album children
+        if media.typename == "GraphSidecar":
+            if media.children is None:
+                node = await self.get_media_node(media)
+                return list(Media.from_node(node).children or [])
+            return list(media.children)
+
+        if media.typename == "GraphVideo" and media.video_url is None:
+            node = await self.get_media_node(media)
+            return [Media.from_node(node)]
+
+        return [media]
 
     async def download_pic(self, url, id, format):
         logger.info(f"Downloading {id}")
-        async with aiohttp.ClientSession() as session:
+
+        # Only the outcome of the downloads is recorded: replays never touch
+        # the CDN and write no files
+        if self.player is not None:
             try:
-                async with session.get(url) as r:
-                    if r.status == 200:
-                        f = await aiofiles.open(
-                            f"./images/{id}.{format}",
-                            mode="wb"
-                        )
-                        await f.write(await r.read())
-                        await f.close()
-                        return True
-                    else:
-                        return False
-            except TimeoutError:
+                res = await self.player.replay("GET", url, None)
+            except KeyError:
+                logger.warning(f"No recorded download of {id}.")
                 return False
+            return res.status == 200
+
+        path = f"{self.settings['download']['path']}/{id}.{format}"
+
+        # Written under a temporary name: an interrupted download never
+        # leaves a partial file behind
+        partial = f"{path}.part"
+        start = time.monotonic()
+        try:
+            async with self.connections.cdn.get(url) as r:
+                if r.status == 200:
+                    async with aiofiles.open(partial, mode="wb") as f:
+                        async for chunk in r.content.iter_chunked(64*1024):
+                            await f.write(chunk)
+                    os.replace(partial, path)
+                res = Response(r.status, r.reason, r.headers, "", str(r.url))
+        except (ClientError, asyncio.TimeoutError):
+            return False
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+        if self.recorder is not None:
+            await self.recorder.record(
+                "GET", url, None, res, time.monotonic() - start
+            )
+        return res.status == 200
 
     async def pic_already_saved(self, id):
         logger.debug("Checking database.")
         async with aiosqlite.connect("./piggy.db") as db:
             row = await db.execute(
-                "SELECT * FROM pics WHERE id=?",
-                (id,)
+                "SELECT 1 FROM pics WHERE id=? OR parent_id=?",
+                (id, id)
             )
 
             if await row.fetchone() is None:
@@ -887,11 +1737,114 @@ class Piggy:
             else:
                 return True
 
-    async def save_to_database(self, id, type, height, width, url, tags):
-        tags = json.dumps(tags)
+    async def save_to_database(
+        self, id, type, height, width, url, tags, caption=None, parent_id=None
+    ):
         async with aiosqlite.connect("./piggy.db") as db:
-            await db.execute(
-                "INSERT INTO pics VALUES(?,?,?,?,?)",
-                (id, height, width, url, tags)
+            c = await db.execute(
+                """
+                INSERT OR IGNORE INTO
+                pics(id, height, width, url, tags, type, parent_id)
+                VALUES(?,?,?,?,?,?,?)
+                """,
+                (id, height, width, url, json.dumps(tags), type, parent_id)
             )
+            if not c.rowcount:
+                # Already saved, e.g. by a concurrent download
+                return
+
+            # Index tags and caption
+            names = [(tag.lower(),) for tag in set(tags)]
+            await db.executemany(
+                "INSERT OR IGNORE INTO tags(name) VALUES(?)",
+                names
+            )
+            await db.executemany(
+                """
+                INSERT OR IGNORE INTO pic_tags
+                SELECT id, ? FROM tags WHERE name=?
+                """,
+                [(id, name) for name, in names]
+            )
+            if caption is not None and self.fts:
+                await db.execute(
+                    "INSERT INTO pics_fts(rowid, caption) VALUES(?,?)",
+                    (int(id), caption)
+                )
+
             await db.commit()
+
+    async def pics_by_tag(self, tag, limit=100, offset=0):
+        """
+        Finds the saved pics with the given hashtag.
+
+        Args:
+            tag: [String] The hashtag, without "#".
+            limit: [Int] Maximum number of results.
+            offset: [Int] Number of results to skip.
+
+        Returns:
+            A list of (id, height, width, url) tuples.
+        """
+
+        async with aiosqlite.connect("./piggy.db") as db:
+            rows = await db.execute(
+                """
+                SELECT pics.id, pics.height, pics.width, pics.url
+                FROM tags
+                JOIN pic_tags ON pic_tags.tag_id=tags.id
+                JOIN pics ON pics.id=pic_tags.pic_id
+                WHERE tags.name=?
+                ORDER BY pic_tags.pic_id DESC
+                LIMIT ? OFFSET ?
+                """,
+                (tag.lower(), limit, offset)
+            )
+            return await rows.fetchall()
+
+    async def top_tags(self, limit=100):
+        """
+        Returns the most used hashtags of the saved pics as a list of
+        (tag, count) tuples.
+        """
+
+        async with aiosqlite.connect("./piggy.db") as db:
+            rows = await db.execute(
+                """
+                SELECT tags.name, COUNT(*) AS n
+                FROM pic_tags JOIN tags ON tags.id=pic_tags.tag_id
+                GROUP BY pic_tags.tag_id
+                ORDER BY n DESC
+                LIMIT ?
+                """,
+                (limit,)
+            )
+            return await rows.fetchall()
+
+    async def search_captions(self, query, limit=100):
+        """
+        Full-text search over the captions of the saved pics.
+
+        Args:
+            query: [String] An FTS5 query, e.g. "sunset AND beach".
+            limit: [Int] Maximum number of results.
+
+        Returns:
+            A list of (id, url, caption) tuples sorted by relevance.
+        """
+
+        if not self.fts:
+            raise ValueError("FTS5 is not available.")
+
+        async with aiosqlite.connect("./piggy.db") as db:
+            rows = await db.execute(
+                """
+                SELECT pics.id, pics.url, pics_fts.caption
+                FROM pics_fts JOIN pics ON pics.id=pics_fts.rowid
+                WHERE pics_fts MATCH ?
+                ORDER BY rank
+                LIMIT ?
+                """,
+                (query, limit)
+            )
+            return await rows.fetchall()
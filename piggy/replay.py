@@ -0,0 +1,137 @@
+import asyncio
+import json
+import logging
+import os
+
+from collections import defaultdict, deque
+from http.cookies import SimpleCookie
+
+import aiofiles
+
+from yarl import URL
+
+from piggy import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+class Response:
+    """
+    Minimal HTTP response with the body already read.
+    """
+
+    __slots__ = ("status", "reason", "headers", "text", "url")
+
+    def __init__(self, status, reason, headers, text, url):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.text = text
+        self.url = url
+
+
+class Recorder:
+    """
+    Appends every request/response pair to a JSON lines file. Request bodies
+    are never written, since they may contain credentials; the recorded
+    headers do contain session cookies, so the file must be kept private.
+    Downloaded files are recorded with an empty body.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    async def open(self):
+        # Readable by the owner only, like the saved session
+        self.f = await aiofiles.open(
+            self.path,
+            mode="a",
+            opener=lambda path, flags: os.open(path, flags, 0o600)
+        )
+        os.chmod(self.path, 0o600)
+        logger.info(f"Recording HTTP traffic to {self.path}")
+
+    async def close(self):
+        if self.f is not None:
+            await self.f.close()
+            self.f = None
+
+    async def record(self, method, url, params, response, elapsed):
+        entry = {
+            "method": method,
+            "url": url,
+            "params": params,
+            "status": response.status,
+            "reason": response.reason,
+            "headers": list(response.headers.items()),
+            "body": response.text,
+            "elapsed": round(elapsed, 4)
+        }
+        await self.f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        await self.f.flush()
+
+
+class Player:
+    """
+    Serves back the responses saved by a Recorder. Responses to the same
+    request are returned in the order they were recorded, after waiting the
+    recorded response time multiplied by "time_scale".
+    """
+
+    def __init__(self, path, cookie_jar, time_scale=1.0):
+        self.path = path
+        self.cookie_jar = cookie_jar
+        self.time_scale = time_scale
+        self.entries = defaultdict(deque)
+
+    def load(self):
+        count = 0
+        with open(self.path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                key = utils.request_key(
+                    entry["method"],
+                    entry["url"],
+                    entry["params"]
+                )
+                self.entries[key].append(entry)
+                count += 1
+        logger.info(f"Loaded {count} recorded responses from {self.path}")
+
+    async def replay(self, method, url, params):
+        """
+        Returns the next recorded response to the given request.
+
+        Raises:
+            KeyError: If no more responses were recorded for the request.
+        """
+
+        key = utils.request_key(method, url, params)
+        try:
+            entry = self.entries[key].popleft()
+        except IndexError:
+            raise KeyError(f"No recorded response for [{method}] {url}")
+
+        if self.time_scale > 0:
+            await asyncio.sleep(entry["elapsed"] * self.time_scale)
+
+        # Restore the cookies set by the server, e.g. the csrf token
+        for name, value in entry["headers"]:
+            if name.lower() == "set-cookie":
+                self.cookie_jar.update_cookies(
+                    SimpleCookie(value),
+                    URL(entry["url"])
+                )
+
+        return Response(
+            entry["status"],
+            entry["reason"],
+            entry["headers"],
+            entry["body"],
+            entry["url"]
+        )
+
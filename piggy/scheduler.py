@@ -0,0 +1,180 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+
+
+class Budget:
+    """
+    Sliding window budget of an action type. Actions are spread evenly so that
+    neither the hourly nor the daily limit is ever reached in a burst. A limit
+    of 0 disables the action.
+    """
+
+    def __init__(self, hourly, daily):
+        self.hourly = hourly
+        self.daily = daily
+        self.disabled = hourly <= 0 or daily <= 0
+        if self.disabled:
+            self.interval = math.inf
+        else:
+            self.interval = max(3600 / hourly, 86400 / daily)
+        self.history = deque()
+
+    def add(self, ts):
+        self.history.append(ts)
+
+    def delay(self, now):
+        """
+        Returns the number of seconds to wait before the next action, or
+        math.inf if the action is disabled.
+        """
+
+        if self.disabled:
+            return math.inf
+
+        while self.history and self.history[0] <= now - 86400:
+            self.history.popleft()
+
+        if not self.history:
+            return 0
+
+        delay = self.history[-1] + self.interval - now
+
+        # Oldest action that has to leave the window to make room for a new one
+        if len(self.history) >= self.daily:
+            delay = max(delay, self.history[-self.daily] + 86400 - now)
+        last_hour = [ts for ts in self.history if ts > now - 3600]
+        if len(last_hour) >= self.hourly:
+            delay = max(delay, last_hour[-self.hourly] + 3600 - now)
+
+        return max(delay, 0)
+
+
+class ActionScheduler:
+    """
+    Schedules likes, comments and follows. Each action type has its own
+    priority queue of pending actions and a worker that executes them at the
+    pace allowed by the action budget. When a queue is full the least
+    interesting action is dropped.
+    """
+
+    def __init__(self, budgets, max_pending=1000):
+        """
+        Args:
+            budgets: [Dict] Hourly and daily limits by action type, e.g.
+            {"like": {"hourly": 60, "daily": 1000}}.
+            max_pending: [Int] Maximum number of pending actions per type.
+        """
+
+        self.budgets = {
+            action: Budget(limits["hourly"], limits["daily"])
+            for action, limits in budgets.items()
+        }
+        self.max_pending = max_pending
+        self.queues = {action: [] for action in budgets}
+        self.keys = {action: set() for action in budgets}
+        self.events = {action: asyncio.Event() for action in budgets}
+        self.counter = itertools.count()
+        self.workers = dict()
+        self.busy = set()
+        self.stopping = False
+
+    def submit(self, action, key, priority, fn, *args):
+        """
+        Adds an action to the queue.
+
+        Args:
+            action: [String] The action type, e.g. "like".
+            key: Identifier of the target, used to discard duplicates.
+            priority: [Number] Lower values are executed first.
+            fn: The coroutine function that executes the action.
+            args: The arguments of fn.
+
+        Returns:
+            True if the action was queued, False otherwise.
+        """
+
+        if self.budgets[action].disabled or key in self.keys[action]:
+            return False
+
+        q = self.queues[action]
+        heapq.heappush(q, (priority, next(self.counter), key, fn, args))
+        self.keys[action].add(key)
+
+        if len(q) > self.max_pending:
+            # Drop the action with the lowest priority
+            dropped = max(q)
+            q.remove(dropped)
+            heapq.heapify(q)
+            self.keys[action].discard(dropped[2])
+            if dropped[2] == key:
+                return False
+
+        self.events[action].set()
+        return True
+
+    def pending(self, action):
+        return len(self.queues[action])
+
+    def start(self):
+        for action, budget in self.budgets.items():
+            if budget.disabled:
+                continue
+            self.workers[action] = asyncio.ensure_future(self._worker(action))
+
+    async def stop(self, timeout=30):
+        """
+        Stops the workers. The actions being executed are given up to
+        "timeout" seconds to complete; the pending ones are discarded.
+        """
+
+        self.stopping = True
+        for action, worker in self.workers.items():
+            if action not in self.busy:
+                worker.cancel()
+
+        workers = list(self.workers.values())
+        if workers:
+            done, pending = await asyncio.wait(workers, timeout=timeout)
+            for worker in pending:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        self.workers = dict()
+
+    async def _worker(self, action):
+        q = self.queues[action]
+        budget = self.budgets[action]
+
+        while 1:
+            if not q:
+                self.events[action].clear()
+                await self.events[action].wait()
+
+            await asyncio.sleep(budget.delay(time.time()))
+
+            # The queue may have changed while sleeping: take the best action
+            if not q:
+                continue
+            priority, _, key, fn, args = heapq.heappop(q)
+            self.keys[action].discard(key)
+
+            self.busy.add(action)
+            try:
+                await fn(*args)
+            except Exception:
+                logger.exception(f"Scheduled {action} failed.")
+            finally:
+                self.busy.discard(action)
+            budget.add(time.time())
+            logger.debug(f"{action}: {len(q)} pending.")
+
+            if self.stopping:
+                return
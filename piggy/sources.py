@@ -0,0 +1,128 @@
+import asyncio
+import logging
+
+from collections import OrderedDict
+from random import choices
+
+
+logger = logging.getLogger(__name__)
+
+
+class Source:
+    """
+    A feed source: an asynchronous generator of pages of media.
+    """
+
+    __slots__ = ("name", "pages", "score", "requests", "media")
+
+    def __init__(self, name, pages, score):
+        self.name = name
+        self.pages = pages
+        self.score = score
+        self.requests = 0
+        self.media = 0
+
+
+class SourceScheduler:
+    """
+    Pulls pages from many feed sources with a bounded number of concurrent
+    requests. Sources take turns one page at a time and the next source is
+    drawn with a probability proportional to its score, a moving average of
+    the new and eligible media it yielded per page, so the most productive
+    sources get most of the requests while the others are still sampled.
+    """
+
+    def __init__(
+        self, sources, q, concurrency=4, eligible=None,
+        initial_score=50, smoothing=0.3, max_seen=100000
+    ):
+        """
+        Args:
+            sources: [List] (name, asynchronous generator of pages) tuples.
+            q: The queue where the media are put.
+            concurrency: [Int] Maximum number of sources fetched at once.
+            eligible: A function that returns False for the media that must
+            be discarded. If None, every media is eligible.
+            initial_score: [Number] Score of the sources never fetched. A high
+            value makes sure every source is tried early.
+            smoothing: [Float] Weight of the last page in the score.
+            max_seen: [Int] Number of media ids remembered to discard
+            duplicates.
+        """
+
+        self.idle = [
+            Source(name, pages, initial_score) for name, pages in sources
+        ]
+        self.q = q
+        self.concurrency = concurrency
+        self.eligible = eligible
+        self.smoothing = smoothing
+        self.max_seen = max_seen
+        self.seen = OrderedDict()
+        self.workers = []
+
+    async def run(self):
+        """
+        Runs the workers until every source is exhausted.
+        """
+
+        self.workers = [
+            asyncio.ensure_future(self._worker())
+            for _ in range(min(self.concurrency, len(self.idle)))
+        ]
+        try:
+            await asyncio.gather(*self.workers)
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def _pick(self):
+        source = choices(self.idle, [s.score + 1 for s in self.idle])[0]
+        self.idle.remove(source)
+        return source
+
+    def _is_new(self, media):
+        if media.id in self.seen:
+            return False
+        self.seen[media.id] = None
+        if len(self.seen) > self.max_seen:
+            self.seen.popitem(last=False)
+        return True
+
+    async def _worker(self):
+        # A worker stops when all the remaining sources are being fetched by
+        # other workers, so there are never more workers than sources
+        while self.idle:
+            source = self._pick()
+            try:
+                page = await source.pages.__anext__()
+            except StopAsyncIteration:
+                logger.debug(f"Source exhausted: {source.name}")
+                continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Source failed: {source.name}")
+                continue
+
+            yielded = 0
+            for media in page:
+                if not self._is_new(media):
+                    continue
+                if self.eligible is not None and not self.eligible(media):
+                    continue
+                yielded += 1
+                await self.q.put(media)
+
+            source.requests += 1
+            source.media += yielded
+            source.score += self.smoothing * (yielded - source.score)
+            logger.debug(
+                f"{source.name}: {yielded} new media, score {source.score:.1f}"
+            )
+            self.idle.append(source)
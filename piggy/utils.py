@@ -37,6 +37,24 @@ def cookies_dict(cookie_jar):
     return cookies
 
 
+def request_key(method, url, params=None):
+    """
+    Builds a hashable key that identifies a request.
+
+    Args:
+        method: [String] The HTTP method.
+        url: [String] The requested URL.
+        params: [String or Dict] The query parameters.
+
+    Returns:
+        A tuple.
+    """
+
+    if isinstance(params, dict):
+        params = tuple(sorted((k, str(v)) for k, v in params.items()))
+    return (method, url, params)
+
+
 def interval_in_seconds(interval):
     exploded_interval = regex.findall(r"([0-9]+)([a-z])", interval)[0]
     value = int(exploded_interval[0])
@@ -22,6 +22,12 @@ setuptools.setup(
         "aiofiles==0.4.0",
         "regex==2019.06.08"
     ],
+    extras_require={
+        "uvloop": ["uvloop"]
+    },
+    entry_points={
+        "console_scripts": ["piggy=piggy.cli:main"]
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",